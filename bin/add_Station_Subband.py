@@ -2,9 +2,10 @@
 """
 Script to sort a list of MSs by into frequency groups by time-stamp
 """
-import pyrap.tables as pt
 import sys, os
 import re
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import ms_catalog
 
 if __name__ == '__main__':
     import argparse
@@ -22,10 +23,8 @@ if __name__ == '__main__':
 
     # inverse of: "_SB\d{3}"
     subReg2 = re.compile(r'\d{3}BS_')
-    for ms in args.ms_files:
-        sw = pt.table(ms+'::SPECTRAL_WINDOW', ack=False)
-        freq = sw.col('REF_FREQUENCY')[0]
-        sw.close()
+    for ms, metadata in zip(args.ms_files, ms_catalog.get_metadata(args.ms_files)):
+        freq = metadata['ref_freq']
 
         station_subband = int(freq/100e6*512.)%512
         ssb_string = "_SSB%03d"%(station_subband)
@@ -0,0 +1,360 @@
+#! /usr/bin/env python
+"""
+Script to benchmark the heavy scripts of prefactor on synthetic data
+
+Synthetic LOFAR-like MSs and FITS images of configurable size are written to a
+work directory, then every hot path is run as a separate process whose wall-clock
+time and peak memory (sampled from /proc) are recorded in a JSON file.
+"""
+import os, sys
+import time
+import json
+import socket
+import shutil
+import subprocess
+import numpy as np
+
+scripts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+bin_dir = os.path.dirname(os.path.abspath(__file__))
+
+# ITRF position of the LOFAR core
+core_position = np.array([3826577.1, 461022.9, 5064892.8])
+
+
+def make_ms(ms_name, nstations=24, ntimes=600, nchans=16, ref_freq=140e6, chan_width=48828.125,
+            interval=4.00556, start_time=4.87e9, seed=0):
+    """
+    Write a synthetic LOFAR-like MS
+
+    Parameters
+    ----------
+    ms_name : str
+        Filename of output MS
+    nstations : int, optional
+        Number of stations, half of them in the core and half spread over ~50 km
+    ntimes : int, optional
+        Number of timeslots
+    nchans : int, optional
+        Number of channels
+    ref_freq : float, optional
+        Reference frequency in Hz
+    chan_width : float, optional
+        Channel width in Hz
+    interval : float, optional
+        Integration time in s
+    start_time : float, optional
+        Start time in MJD seconds
+    seed : int, optional
+        Seed of the random generator
+    """
+    import pyrap.tables as pt
+
+    rs = np.random.RandomState(seed)
+    ncorr = 4
+    coldesc = [pt.makearrcoldesc(col, 0j, shape=[nchans, ncorr], valuetype='complex')
+               for col in ('DATA', 'MODEL_DATA')]
+    coldesc.append(pt.makearrcoldesc('WEIGHT_SPECTRUM', 0., shape=[nchans, ncorr], valuetype='float'))
+    ms = pt.default_ms(ms_name, pt.maketabdesc(coldesc))
+
+    # stations: half in the core (~2 km), half remote (~50 km)
+    ncore = nstations // 2
+    positions = core_position + np.concatenate((rs.normal(scale=1.e3, size=(ncore, 3)),
+                                                rs.normal(scale=3.e4, size=(nstations-ncore, 3))))
+    ant = pt.table(ms_name + '/ANTENNA', readonly=False, ack=False)
+    ant.addrows(nstations)
+    ant.putcol('NAME', ['CS%03dHBA0' % i for i in range(ncore)] + ['RS%03dHBA' % i for i in range(nstations-ncore)])
+    ant.putcol('POSITION', positions)
+    ant.putcol('DISH_DIAMETER', np.ones(nstations) * 30.75)
+    ant.close()
+
+    sw = pt.table(ms_name + '/SPECTRAL_WINDOW', readonly=False, ack=False)
+    sw.addrows(1)
+    chan_freqs = ref_freq + (np.arange(nchans) - nchans/2.) * chan_width
+    sw.putcell('REF_FREQUENCY', 0, ref_freq)
+    sw.putcell('NUM_CHAN', 0, nchans)
+    sw.putcell('CHAN_FREQ', 0, chan_freqs)
+    sw.putcell('CHAN_WIDTH', 0, np.ones(nchans) * chan_width)
+    sw.putcell('EFFECTIVE_BW', 0, np.ones(nchans) * chan_width)
+    sw.putcell('RESOLUTION', 0, np.ones(nchans) * chan_width)
+    sw.putcell('TOTAL_BANDWIDTH', 0, nchans * chan_width)
+    sw.close()
+
+    field = pt.table(ms_name + '/FIELD', readonly=False, ack=False)
+    field.addrows(1)
+    for col in ('PHASE_DIR', 'DELAY_DIR', 'REFERENCE_DIR'):
+        field.putcell(col, 0, np.array([[2.1, 0.85]]))
+    field.close()
+
+    obs = pt.table(ms_name + '/OBSERVATION', readonly=False, ack=False)
+    obs.addrows(1)
+    obs.putcell('TIME_RANGE', 0, np.array([start_time, start_time + ntimes * interval]))
+    obs.putcell('TELESCOPE_NAME', 0, 'LOFAR')
+    obs.close()
+
+    # main table, one timeslot at a time to keep the memory low
+    ant1, ant2 = np.triu_indices(nstations)
+    nbl = len(ant1)
+    ms.addrows(nbl * ntimes)
+    for t in range(ntimes):
+        time_t = start_time + (t + 0.5) * interval
+        # rotate the baselines with the hour angle
+        ha = 2. * np.pi * (time_t - start_time) / 86164.1
+        rot = np.array([[np.cos(ha), -np.sin(ha), 0.], [np.sin(ha), np.cos(ha), 0.], [0., 0., 1.]])
+        uvw = np.dot(positions[ant2] - positions[ant1], rot.T)
+        shape = (nbl, nchans, ncorr)
+        data = (rs.normal(size=shape) + 1j * rs.normal(size=shape)).astype(np.complex64)
+        row = t * nbl
+        ms.putcol('TIME', np.ones(nbl) * time_t, row, nbl)
+        ms.putcol('TIME_CENTROID', np.ones(nbl) * time_t, row, nbl)
+        ms.putcol('INTERVAL', np.ones(nbl) * interval, row, nbl)
+        ms.putcol('EXPOSURE', np.ones(nbl) * interval, row, nbl)
+        ms.putcol('ANTENNA1', ant1, row, nbl)
+        ms.putcol('ANTENNA2', ant2, row, nbl)
+        ms.putcol('UVW', uvw, row, nbl)
+        ms.putcol('DATA', data, row, nbl)
+        ms.putcol('MODEL_DATA', data * 10., row, nbl)
+        ms.putcol('WEIGHT_SPECTRUM', np.ones(shape, dtype=np.float32), row, nbl)
+        ms.putcol('FLAG', rs.uniform(size=shape) < 0.02, row, nbl)
+    ms.close()
+
+
+def make_image(image_name, npix=2048, freq=140e6, cellsize_deg=0.00208, nsources=50, noise=1.e-3, seed=0):
+    """
+    Write a synthetic FITS image (as written by WSClean) with Gaussian noise and point sources
+
+    Parameters
+    ----------
+    image_name : str
+        Filename of output image
+    npix : int, optional
+        Number of pixels on a side
+    freq : float, optional
+        Frequency in Hz
+    cellsize_deg : float, optional
+        Size of a pixel in degrees
+    nsources : int, optional
+        Number of sources
+    noise : float, optional
+        rms of the noise in Jy/beam
+    seed : int, optional
+        Seed of the random generator
+    """
+    from astropy.io import fits as pyfits
+    from scipy.ndimage import gaussian_filter
+
+    rs = np.random.RandomState(seed)
+    data = rs.normal(scale=noise, size=(npix, npix)).astype(np.float32)
+    sources = np.zeros((npix, npix), dtype=np.float32)
+    x, y = rs.randint(0, npix, size=(2, nsources))
+    sources[y, x] = rs.uniform(0.05, 5., size=nsources)
+    # beam of ~3 pixels FWHM
+    data += gaussian_filter(sources, 1.3) * 2. * np.pi * 1.3**2
+
+    hdu = pyfits.PrimaryHDU(data[np.newaxis, np.newaxis, :, :])
+    header = hdu.header
+    header['BSCALE'] = 1.
+    header['BZERO'] = 0.
+    header['BUNIT'] = 'JY/BEAM'
+    header['BMAJ'] = 3. * cellsize_deg
+    header['BMIN'] = 3. * cellsize_deg
+    header['BPA'] = 0.
+    header['EQUINOX'] = 2000.
+    header['CTYPE1'] = 'RA---SIN'
+    header['CRPIX1'] = npix/2 + 1
+    header['CRVAL1'] = 120.
+    header['CDELT1'] = -cellsize_deg
+    header['CUNIT1'] = 'deg'
+    header['CTYPE2'] = 'DEC--SIN'
+    header['CRPIX2'] = npix/2 + 1
+    header['CRVAL2'] = 48.7
+    header['CDELT2'] = cellsize_deg
+    header['CUNIT2'] = 'deg'
+    header['CTYPE3'] = 'FREQ'
+    header['CRPIX3'] = 1.
+    header['CRVAL3'] = freq
+    header['CDELT3'] = 1.e6
+    header['CUNIT3'] = 'Hz'
+    header['CTYPE4'] = 'STOKES'
+    header['CRPIX4'] = 1.
+    header['CRVAL4'] = 1.
+    header['CDELT4'] = 1.
+    header['CUNIT4'] = ''
+    header['SPECSYS'] = 'TOPOCENT'
+    header['TELESCOP'] = 'LOFAR'
+    hdu.writeto(image_name)
+
+
+def get_tree_rss(pid):
+    """
+    Return the resident memory in MB of a process and of all its descendants (Linux only)
+    """
+    children = {}
+    for proc in os.listdir('/proc'):
+        if not proc.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % proc) as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, OSError):
+            continue
+        children.setdefault(ppid, []).append(int(proc))
+
+    rss = 0.
+    tree = [pid]
+    while tree:
+        proc = tree.pop()
+        tree.extend(children.get(proc, []))
+        try:
+            with open('/proc/%i/status' % proc) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1]) / 1024.
+        except (IOError, OSError):
+            continue
+    return rss
+
+
+def run_benchmark(name, command, cwd, repeat=1, interval=0.1):
+    """
+    Run a command and return a dict with its wall-clock time and peak memory
+
+    The peak memory is the largest sum of the resident memory of the process and
+    of its sub-processes, sampled every interval seconds.
+    """
+    result = {'name': name, 'command': command, 'wall_time_s': [], 'max_rss_mb': [], 'returncode': 0}
+    for i in range(repeat):
+        print('Running %s (%i/%i): %s' % (name, i+1, repeat, ' '.join(command)))
+        logfile = open(os.path.join(cwd, name + '.log'), 'a')
+        start = time.time()
+        proc = subprocess.Popen(command, cwd=cwd, stdout=logfile, stderr=subprocess.STDOUT)
+        max_rss = 0.
+        while proc.poll() is None:
+            max_rss = max(max_rss, get_tree_rss(proc.pid))
+            time.sleep(interval)
+        result['wall_time_s'].append(time.time() - start)
+        result['max_rss_mb'].append(max_rss)
+        result['returncode'] = proc.returncode
+        logfile.close()
+        if result['returncode'] != 0:
+            print('%s failed with return code %i, see %s.log' % (name, result['returncode'], name))
+            break
+    return result
+
+
+def main(workdir, output='benchmark.json', nstations=24, ntimes=600, nchans=16, nms=4,
+         npix=2048, nimages=3, repeat=1, only=None, python=None, keep=False):
+    """
+    Generate the synthetic data and benchmark the scripts
+
+    Parameters
+    ----------
+    workdir : str
+        Directory for the synthetic data and the logs of the benchmarks
+    output : str, optional
+        Name of the JSON file with the results
+    nstations, ntimes, nchans : int, optional
+        Size of every synthetic MS
+    nms : int, optional
+        Number of MSs (subbands) to generate
+    npix : int, optional
+        Number of pixels on a side of the synthetic images
+    nimages : int, optional
+        Number of images to generate
+    repeat : int, optional
+        How many times each benchmark is run
+    only : list of str, optional
+        Run only the benchmarks whose name starts with one of these strings
+    python : str, optional
+        Python interpreter for the scripts (default: the one running this script)
+    keep : bool, optional
+        Keep the synthetic data in workdir
+    """
+    if python is None:
+        python = sys.executable
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    msnames = [ 'bench_SB%03d.MS' % i for i in range(nms) ]
+    images = [ 'bench_image_%i.fits' % i for i in range(nimages) ]
+    start = time.time()
+    for i, msname in enumerate(msnames):
+        if not os.path.exists(os.path.join(workdir, msname)):
+            print('Writing %s' % msname)
+            make_ms(os.path.join(workdir, msname), nstations, ntimes, nchans,
+                    ref_freq=120e6 + i * 195312.5, seed=i)
+    for i, image in enumerate(images):
+        if not os.path.exists(os.path.join(workdir, image)):
+            print('Writing %s' % image)
+            make_image(os.path.join(workdir, image), npix, freq=120e6 + i * 1e6, seed=i)
+    generation_time = time.time() - start
+
+    script = lambda name: os.path.join(scripts_dir, name)
+    benchmarks = [
+        ('BLsmooth', [python, script('BLsmooth.py'), '-r', msnames[0]]),
+        ('BLsmooth_single_antenna', [python, script('BLsmooth.py'), '-r', '-P', '-L', 'antenna', '-d', msnames[0]]),
+        ('BLsmooth_iir', [python, script('BLsmooth.py'), '-r', '-B', 'iir', msnames[0]]),
+        ('BLsmooth_windows', [python, script('BLsmooth.py'), '-r', '-m', '0.5', msnames[0]]),
+        ('BLsmooth_batch', [python, script('BLsmooth.py'), '-r', '-n', str(min(nms, 4))] + msnames),
+        ('Ateamclipper', [python, script('Ateamclipper.py'), msnames[0]]),
+        ('sort_times_into_freqGroups', [python, script('sort_times_into_freqGroups.py'), 'bench_SB*.MS',
+                                        '-n', str(max(nms // 2, 1)), '-f', 'bench.mapfile']),
+        ('make_clean_mask', [python, script('make_clean_mask.py'), images[0], 'bench_mask.fits',
+                             '-f', 'fits', '-i', '3', '-p', '5']),
+        ('concat_initsubtract_images', [python, os.path.join(bin_dir, 'concat_initsubtract_images.py'),
+                                        'bench_image_*.fits', 'bench_concat.fits']),
+        ]
+
+    results = []
+    for name, command in benchmarks:
+        if only and not any(name.startswith(o) for o in only):
+            continue
+        # outputs of a previous run would make some scripts fail
+        for outfile in ('bench_mask.fits', 'bench_concat.fits'):
+            if os.path.exists(os.path.join(workdir, outfile)):
+                os.remove(os.path.join(workdir, outfile))
+        results.append(run_benchmark(name, command, workdir, repeat))
+
+    summary = {'host': socket.gethostname(),
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': python,
+               'parameters': {'nstations': nstations, 'ntimes': ntimes, 'nchans': nchans, 'nms': nms,
+                              'npix': npix, 'nimages': nimages, 'repeat': repeat},
+               'generation_time_s': generation_time,
+               'benchmarks': results}
+    with open(output, 'w') as f:
+        json.dump(summary, f, indent=2)
+    print('Results written to %s' % output)
+
+    if not keep:
+        for name in msnames + images:
+            path = os.path.join(workdir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    return summary
+
+
+if __name__ == '__main__':
+    import argparse
+    descriptiontext = "Benchmark the heavy scripts of prefactor on synthetic MSs and images.\n"
+
+    parser = argparse.ArgumentParser(description=descriptiontext)
+    parser.add_argument('workdir', help='Directory for the synthetic data and the logs of the benchmarks.')
+    parser.add_argument('-o', '--output', help='JSON file with the results. (default: benchmark.json)', default='benchmark.json')
+    parser.add_argument('--stations', help='Number of stations. (default: 24)', type=int, default=24)
+    parser.add_argument('--times', help='Number of timeslots per MS. (default: 600)', type=int, default=600)
+    parser.add_argument('--channels', help='Number of channels per MS. (default: 16)', type=int, default=16)
+    parser.add_argument('--nms', help='Number of MSs (subbands). (default: 4)', type=int, default=4)
+    parser.add_argument('--pixels', help='Number of pixels on a side of the images. (default: 2048)', type=int, default=2048)
+    parser.add_argument('--nimages', help='Number of images. (default: 3)', type=int, default=3)
+    parser.add_argument('--repeat', help='Number of runs of every benchmark. (default: 1)', type=int, default=1)
+    parser.add_argument('--only', help='Comma-separated list of benchmarks to run (prefixes of their names).', default=None)
+    parser.add_argument('--python', help='Python interpreter for the scripts. (default: the current one)', default=None)
+    parser.add_argument('--keep', action='store_true', help='Keep the synthetic data in workdir.')
+
+    args = parser.parse_args()
+    only = args.only.split(',') if args.only else None
+    main(args.workdir, args.output, args.stations, args.times, args.channels, args.nms,
+         args.pixels, args.nimages, args.repeat, only, args.python, args.keep)
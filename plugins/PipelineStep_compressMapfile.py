@@ -1,5 +1,8 @@
 import os
+import sys
 from lofarpipe.support.data_map import DataMap, DataProduct
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import host_assignment
 
 
 def plugin_main(args, **kwargs):
@@ -19,6 +22,10 @@ def plugin_main(args, **kwargs):
         Directory for output mapfile
     filename: str
         Name of output mapfile
+    host_mounts: str, optional
+        Mounts of the hosts ("host1:/mnt/a,/mnt/b;host2:/mnt/c"). Every output item
+        goes to the host that stores most of its files, balanced over the hosts
+        (see scripts/host_assignment.py)
 
     Returns
     -------
@@ -33,31 +40,32 @@ def plugin_main(args, **kwargs):
         nitems_to_compress = int(float(kwargs['nitems_to_compress']))
     else:
         nitems_to_compress = -1
+    host_mounts = kwargs.get('host_mounts')
 
     map_in = MultiDataMap.load(mapfile_in)
     map_out = MultiDataMap([])
     map_in.iterator = DataMap.SkipIterator
+    all_files = []
+    file_hosts = {}
+    hosts = []
+    for item in map_in:
+        if type(item.file) is list:
+            all_files.extend(item.file)
+            item_files = item.file
+        else:
+            all_files.append(item.file)
+            item_files = [item.file]
+        for f in item_files:
+            file_hosts[f] = item.host
+        if not item.host in hosts:
+            hosts.append(item.host)
     if nitems_to_compress > 0:
-        all_files = []
-        for item in map_in:
-            if type(item.file) is list:
-                all_files.extend(item.file)
-            else:
-                all_files.append(item.file)
         file_groups = [all_files[i:i+nitems_to_compress] for i  in range(0, len(all_files), nitems_to_compress)]
-        all_hosts = [item.host for item in map_in]
-        host_groups = [all_hosts[i:i+nitems_to_compress] for i  in range(0, len(all_hosts), nitems_to_compress)]
-        for file_list, host_list in zip(file_groups, host_groups):
-            map_out.data.append(MultiDataProduct(host_list[0], file_list, False))
     else:
-        file_list = []
-        for item in map_in:
-            if type(item.file) is list:
-                file_list.extend(item.file)
-            else:
-                file_list.append(item.file)
-        host_list = [item.host for item in map_in]
-        map_out.data.append(MultiDataProduct(host_list[0], file_list, False))
+        file_groups = [all_files]
+    group_hosts = host_assignment.assign_hosts(file_groups, hosts, file_hosts=file_hosts, host_mounts=host_mounts)
+    for file_list, host in zip(file_groups, group_hosts):
+        map_out.data.append(MultiDataProduct(host, file_list, False))
 
     fileid = os.path.join(mapfile_dir, filename)
     map_out.save(fileid)
@@ -5,7 +5,10 @@ Identify fully flagged antennas
 
 from lofarpipe.support.data_map import DataMap, DataProduct
 import os
+import sys
 import multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import resource_budget
 
 def find_flagged_antennas(ms_file):
     
@@ -36,7 +39,7 @@ def plugin_main(args, **kwargs):
     data           = DataMap.load(mapfile_in)
     mslist         = [data[i].file for i in xrange(len(data))]
     
-    pool = multiprocessing.Pool(processes = multiprocessing.cpu_count())
+    pool = multiprocessing.Pool(processes = max(min(resource_budget.get_cpu_budget(), len(mslist)), 1))
     flaggedants_list = pool.map(find_flagged_antennas, mslist)
    
     flagged_antenna_list = set.intersection(*map(set, flaggedants_list)) 
@@ -1,6 +1,9 @@
 import os
-import casacore.tables as pt
+import sys
 from lofarpipe.support.data_map import DataMap, DataProduct
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import ms_catalog
+import host_assignment
 
 
 def get_distributed_indices(start, end, n):
@@ -24,6 +27,9 @@ def plugin_main(args, **kwargs):
         Name of output mapfile
     num: int, optional
         Number of frequencies in output mapfile
+    host_mounts: str, optional
+        Mounts of the hosts ("host1:/mnt/a,/mnt/b;host2:/mnt/c"), to put every
+        file on the host that stores it (see scripts/host_assignment.py)
 
     Returns
     -------
@@ -38,6 +44,7 @@ def plugin_main(args, **kwargs):
         num = int(kwargs['num'])
     else:
         num = 6
+    host_mounts = kwargs.get('host_mounts')
     fileid = os.path.join(mapfile_dir, filename)
 
     map_in = DataMap.load(mapfile_in)
@@ -52,20 +59,31 @@ def plugin_main(args, **kwargs):
         return  {'mapfile': fileid}
 
     #sort into frequency groups
-    freq_groups = {}
-    hosts = []
+    items = []
+    ms_files = []
+    item_files = {}
+    file_hosts = {}
     for item in map_in:
         if '[' in item.file and ']' in item.file:
             files = item.file.strip('[]').split(',')
             files = [f.strip() for f in files]
             ms_file = files[0]
         else:
+            files = [item.file]
             ms_file = item.file
+        item_files[item.file] = files
+        for f in files:
+            file_hosts[f] = item.host
+        items.append(item)
+        ms_files.append(ms_file)
+
+    # Get the frequency info of all MS files
+    metadata = ms_catalog.get_metadata(ms_files)
 
-        # Get the frequency info from the MS file
-        sw = pt.table(ms_file+'::SPECTRAL_WINDOW', ack=False)
-        freq = int(sw.col('REF_FREQUENCY')[0])
-        sw.close()
+    freq_groups = {}
+    hosts = []
+    for item, ms_metadata in zip(items, metadata):
+        freq = int(ms_metadata['ref_freq'])
         if freq in freq_groups:
             freq_groups[freq].append(item.file)
         else:
@@ -93,12 +111,12 @@ def plugin_main(args, **kwargs):
     for selfreq in selfreqs:
         all_files.extend(freq_groups[selfreq])
 
-    # extend the hosts-list
-    for i in range(len(all_files)-len(hosts)):
-        hosts.append(hosts[i])
+    # put every file on the host that stores it, balanced over the hosts
+    file_hosts_out = host_assignment.assign_hosts([item_files[fname] for fname in all_files], hosts,
+                                                  file_hosts=file_hosts, host_mounts=host_mounts)
 
     # fill the output-map
-    for (host,fname) in zip(hosts,all_files):
+    for (host,fname) in zip(file_hosts_out,all_files):
         map_out.append(DataProduct(host, fname, False))
 
     map_out.save(fileid)
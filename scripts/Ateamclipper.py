@@ -7,6 +7,7 @@
 import numpy
 import pyrap.tables as pt
 import sys
+import resource_budget
 
 msname = str(sys.argv[1])
 
@@ -14,8 +15,6 @@ cliplevelhba = 5.0
 cliplevellba = 50.0
 
 t = pt.table(msname, readonly=False)
-data = t.getcol('MODEL_DATA')
-flag = t.getcol('FLAG')
 freq_tab= pt.table(msname + '/SPECTRAL_WINDOW')
 freq    = freq_tab.getcol('REF_FREQUENCY')
 
@@ -24,34 +23,44 @@ if freq[0] > 100e6:
 if freq[0] < 100e6:
  cliplevel = cliplevellba
 
+# process the MS in chunks of rows that fit in half of the memory budget,
+# per row we hold MODEL_DATA, FLAG and the temporaries of the clipping
+nrows       = t.nrows()
+cell        = t.getcell('MODEL_DATA', 0)
+nchan, ncorr = cell.shape
+rowsize     = nchan * ncorr * (cell.itemsize + cell.real.itemsize + 2)
+chunkrows   = max(int(0.5 * resource_budget.get_memory_budget() / rowsize), 1)
+
+flagged_in  = numpy.zeros((nchan, ncorr), dtype=int)
+flagged_out = numpy.zeros((nchan, ncorr), dtype=int)
+for startrow in range(0, nrows, chunkrows):
+  nrow = min(chunkrows, nrows - startrow)
+  data = t.getcol('MODEL_DATA', startrow, nrow)
+  flag = t.getcol('FLAG', startrow, nrow)
+  flagged_in += numpy.sum(flag, axis=0)
+  # a sample above the cliplevel in any polarization flags all correlations
+  flag[numpy.any(abs(data) > cliplevel, axis=2)] = True
+  flagged_out += numpy.sum(flag, axis=0)
+  t.putcol('FLAG', flag, startrow, nrow)
+
 
 print '------------------------------'
 print 'SB Frequency [MHz]', freq[0]/1e6
-for chan in range(0,numpy.size(data[0,:,0])):
-  print 'chan %i : %.5f%% input XX flagged' %( chan, 100.*numpy.sum(flag[:,chan,0] == True)/numpy.size(flag[:,chan,0]) )
-  print 'chan %i : %.5f%% input YY flagged' %( chan, 100.*numpy.sum(flag[:,chan,3] == True)/numpy.size(flag[:,chan,3]) )
-print 'Total : %.5f%% input XX flagged' %(  100.*numpy.sum(flag[:,:,0] == True)/numpy.size(flag[:,:,0]) )
-print 'Total : %.5f%% input YY flagged' %(  100.*numpy.sum(flag[:,:,3] == True)/numpy.size(flag[:,:,3]) )
+for chan in range(0,nchan):
+  print 'chan %i : %.5f%% input XX flagged' %( chan, 100.*flagged_in[chan,0]/nrows )
+  print 'chan %i : %.5f%% input YY flagged' %( chan, 100.*flagged_in[chan,3]/nrows )
+print 'Total : %.5f%% input XX flagged' %(  100.*numpy.sum(flagged_in[:,0])/(nrows*nchan) )
+print 'Total : %.5f%% input YY flagged' %(  100.*numpy.sum(flagged_in[:,3])/(nrows*nchan) )
 print ''
 print 'Cliplevel used [Jy]', cliplevel
 print '\n\n'
 
-for pol in range(0,numpy.size(data[0,0,:])):
- for chan in range(0,numpy.size(data[0,:,0])):
-  print 'Doing polarization,chan', pol, chan
-  idx = numpy.where(abs(data[:,chan,pol]) > cliplevel)
-  flag[idx,chan,0] = True
-  flag[idx,chan,1] = True
-  flag[idx,chan,2] = True
-  flag[idx,chan,3] = True 
-
 print ''
-for chan in range(0,numpy.size(data[0,:,0])):
-  print 'chan %i : %.5f%% output XX flagged' %( chan, 100.*numpy.sum(flag[:,chan,0] == True)/numpy.size(flag[:,chan,0]) )
-  print 'chan %i : %.5f%% output YY flagged' %( chan, 100.*numpy.sum(flag[:,chan,3] == True)/numpy.size(flag[:,chan,3]) )
-print 'Total : %.5f%% output XX flagged' %(  100.*numpy.sum(flag[:,:,0] == True)/numpy.size(flag[:,:,0]) )
-print 'Total : %.5f%% output YY flagged' %(  100.*numpy.sum(flag[:,:,3] == True)/numpy.size(flag[:,:,3]) )
+for chan in range(0,nchan):
+  print 'chan %i : %.5f%% output XX flagged' %( chan, 100.*flagged_out[chan,0]/nrows )
+  print 'chan %i : %.5f%% output YY flagged' %( chan, 100.*flagged_out[chan,3]/nrows )
+print 'Total : %.5f%% output XX flagged' %(  100.*numpy.sum(flagged_out[:,0])/(nrows*nchan) )
+print 'Total : %.5f%% output YY flagged' %(  100.*numpy.sum(flagged_out[:,3])/(nrows*nchan) )
 print ''
-t.putcol('FLAG', flag)
 t.close()
 freq_tab.close()
@@ -21,148 +21,632 @@
 # Load a MS, average visibilities according to the baseline lenght,
 # i.e. shorter BLs are averaged more, and write a new MS
 
-import os, sys, time
+import os, sys, time, copy
 import optparse, itertools
-import logging
+import logging, multiprocessing
 import numpy as np
 from scipy.ndimage.filters import gaussian_filter1d as gfilter
+from scipy.signal import lfilter, lfilter_zi
+from scipy.optimize import brentq
 import pyrap.tables as pt
+import resource_budget
 logging.basicConfig(level=logging.DEBUG)
 
-def addcol(ms, incol, outcol):
+# gfilter() cuts the Gaussian kernel at truncate*sigma
+truncate = 4.
+
+def addcol(ms, incol, outcol, copy=True):
     if outcol not in ms.colnames():
         logging.info('Adding column: '+outcol)
         coldmi = ms.getdminfo(incol)
         coldmi['NAME'] = outcol
         ms.addcols(pt.makecoldesc(outcol, ms.getcoldesc(incol)), coldmi)
-    if outcol != incol:
+    if outcol != incol and copy:
         # copy columns val
         logging.info('Set '+outcol+'='+incol)
         pt.taql("update $ms set "+outcol+"="+incol)
 
-opt = optparse.OptionParser(usage="%prog [options] MS", version="%prog 0.1")
-opt.add_option('-f', '--ionfactor', help='Gives an indication on how strong is the ionosphere [default: 0.2]', type='float', default=0.2)
-opt.add_option('-s', '--bscalefactor', help='Gives an indication on how the smoothing varies with BL-lenght [default: 0.5]', type='float', default=0.5)
-opt.add_option('-i', '--incol', help='Column name to smooth [default: DATA]', type='string', default='DATA')
-opt.add_option('-o', '--outcol', help='Output column [default: SMOOTHED_DATA]', type="string", default='SMOOTHED_DATA')
-opt.add_option('-w', '--weight', help='Save the newly computed WEIGHT_SPECTRUM, this action permanently modify the MS! [default: False]', action="store_true", default=False)
-opt.add_option('-r', '--restore', help='If WEIGHT_SPECTRUM_ORIG exists then restore it before smoothing [default: False]', action="store_true", default=False)
-opt.add_option('-b', '--nobackup', help='Do not backup the old WEIGHT_SPECTRUM in WEIGHT_SPECTRUM_ORIG [default: do backup if -w]', action="store_true", default=False)
-opt.add_option('-a', '--onlyamp', help='Smooth only amplitudes [default: smooth real/imag]', action="store_true", default=False)
-opt.add_option('-S', '--smooth', help='Performs smoothing (otherwise column will be only copied)', type="string", default=True)
-(options, msfile) = opt.parse_args()
-
-if msfile == []:
-    opt.print_help()
-    sys.exit(0)
-msfile = msfile[0]
-
-if not os.path.exists(msfile):
-    logging.error("Cannot find MS file.")
-    sys.exit(1)
-
-# open input/output MS
-ms = pt.table(msfile, readonly=False, ack=False)
-        
-freqtab = pt.table(msfile + '/SPECTRAL_WINDOW', ack=False)
-freq = freqtab.getcol('REF_FREQUENCY')[0]
-freqtab.close()
-wav = 299792458. / freq
-timepersample = ms.getcell('INTERVAL',0)
-
-# check if ms is time-ordered
-times = ms.getcol('TIME_CENTROID')
-if not all(times[i] <= times[i+1] for i in range(len(times)-1)):
-    logging.critical('This code cannot handle MS that are not time-sorted.')
-    sys.exit(1)
-
-# create column to smooth
-addcol(ms, options.incol, options.outcol)
-# if smoothing should not be performed
-if options.smooth == 'False':
-    sys.exit(0)
-
-# retore WEIGHT_SPECTRUM
-if 'WEIGHT_SPECTRUM_ORIG' in ms.colnames() and options.restore:
-    addcol(ms, 'WEIGHT_SPECTRUM_ORIG', 'WEIGHT_SPECTRUM')
-# backup WEIGHT_SPECTRUM
-elif options.weight and not options.nobackup:
-    addcol(ms, 'WEIGHT_SPECTRUM', 'WEIGHT_SPECTRUM_ORIG')
-
-# iteration on antenna1
-for ms_ant1 in ms.iter(["ANTENNA1"]):
-    ant1 = ms_ant1.getcol('ANTENNA1')[0]
-    a_ant2 = ms_ant1.getcol('ANTENNA2')
-    logging.debug('Working on antenna: %s' % ant1)
-
-    a_uvw = ms_ant1.getcol('UVW')
-    a_data = ms_ant1.getcol(options.outcol)
-    a_weights = ms_ant1.getcol('WEIGHT_SPECTRUM')
-    a_flags = ms_ant1.getcol('FLAG')
- 
-    for ant2 in set(a_ant2):
-        if ant1 == ant2: continue # skip autocorr
-        idx = np.where(a_ant2 == ant2)
-        
-        uvw = a_uvw[idx]
-        data = a_data[idx]
-        weights = a_weights[idx]
-        flags = a_flags[idx]
-   
-        # compute the FWHM
+def is_time_sorted(ms, col='TIME_CENTROID', chunkrows=1000000):
+    """
+    Check if the rows of the MS are sorted in time, reading col in chunks of chunkrows rows.
+    """
+    last = -np.inf
+    for startrow in range(0, ms.nrows(), chunkrows):
+        times = ms.getcol(col, startrow, min(chunkrows, ms.nrows()-startrow))
+        if times[0] < last or np.any(np.diff(times) < 0):
+            return False
+        last = times[-1]
+    return True
+
+def get_baseline_lengths(ms, nant, chunkrows=1000000, maxrows=0):
+    """
+    Return the mean length in km of every baseline, as {(ant1, ant2): dist}.
+    The UVW column is read in chunks of chunkrows rows. If maxrows > 0, only
+    10 evenly spaced blocks of maxrows/10 rows are read (each block should
+    contain at least one timeslot of a time-sorted MS), baselines that are not
+    in these blocks are left out.
+    """
+    if maxrows > 0 and ms.nrows() > maxrows:
+        nrow = maxrows // 10
+        blocks = [ (startrow, nrow) for startrow in np.linspace(0, ms.nrows()-nrow, 10).astype(int) ]
+    else:
+        blocks = [ (startrow, min(chunkrows, ms.nrows()-startrow)) for startrow in range(0, ms.nrows(), chunkrows) ]
+
+    blsum = np.zeros(nant*nant)
+    blcount = np.zeros(nant*nant)
+    for startrow, nrow in blocks:
+        blid = ms.getcol('ANTENNA1', startrow, nrow)*nant + ms.getcol('ANTENNA2', startrow, nrow)
+        uvw = ms.getcol('UVW', startrow, nrow)
         uvw_dist = np.sqrt(uvw[:, 0]**2 + uvw[:, 1]**2 + uvw[:, 2]**2)
-        dist = np.mean(uvw_dist) / 1.e3
+        blsum += np.bincount(blid, weights=uvw_dist, minlength=nant*nant)
+        blcount += np.bincount(blid, minlength=nant*nant)
+    return dict( ((b // nant, b % nant), blsum[b] / blcount[b] / 1.e3) for b in np.where(blcount > 0)[0] )
+
+def get_antenna_baseline_lengths(msfile):
+    """
+    Return the length in km of every baseline from the antenna positions, as {(ant1, ant2): dist}.
+    This is the length of the UVW vectors, without reading the UVW column.
+    """
+    anttab = pt.table(msfile + '/ANTENNA', ack=False)
+    pos = anttab.getcol('POSITION')
+    anttab.close()
+    dist = np.sqrt(np.sum((pos[np.newaxis, :, :] - pos[:, np.newaxis, :])**2, axis=2)) / 1.e3
+    return dict( ((ant1, ant2), dist[ant1, ant2]) for ant1 in range(len(pos)) for ant2 in range(len(pos)) )
+
+def get_baseline_sigmas(bl_dist, freq, timepersample, ionfactor, bscalefactor, sigmares=0.):
+    """
+    Return the Gaussian sigma (in samples) of every baseline that has to be smoothed, as {(ant1, ant2): stddev}.
+    Autocorrelations and baselines with a too small smoothing are left out.
+    If sigmares > 0 the sigmas are rounded to a multiple of it, so that more
+    baselines share the same kernel and are filtered together.
+    """
+    bl_stddev = {}
+    for (ant1, ant2), dist in sorted(bl_dist.items()):
+        if ant1 == ant2: continue # skip autocorr
         if np.isnan(dist): continue # fix for missing anstennas
-    
-        stddev = options.ionfactor * (25.e3 / dist)**options.bscalefactor * (freq / 60.e6) # in sec
+
+        stddev = ionfactor * (25.e3 / dist)**bscalefactor * (freq / 60.e6) # in sec
         stddev = stddev/timepersample # in samples
         logging.debug("%s - %s: dist = %.1f km: sigma=%.2f samples." % (ant1, ant2, dist, stddev))
-    
+
         if stddev == 0: continue # fix for flagged antennas
         if stddev < 0.5: continue # avoid very small smoothing
-    
-        flags[ np.isnan(data) ] = True # flag NaNs
-        weights[flags] = 0 # set weight of flagged data to 0
-        del flags
-        
-        # Multiply every element of the data by the weights, convolve both the scaled data and the weights, and then
-        # divide the convolved data by the convolved weights (translating flagged data into weight=0). That's basically the equivalent of a
-        # running weighted average with a Gaussian window function.
-        
-        # set bad data to 0 so nans do not propagate
-        data = np.nan_to_num(data*weights)
-        
-        # smear weighted data and weights
-        if options.onlyamp:
-            dataAMP = gfilter(np.abs(data), stddev, axis=0)
-            dataPH = np.angle(data)
-        else:
-            dataR = gfilter(np.real(data), stddev, axis=0)#, truncate=4.)
-            dataI = gfilter(np.imag(data), stddev, axis=0)#, truncate=4.)
-    
-        weights = gfilter(weights, stddev, axis=0)#, truncate=4.)
-    
-        # re-create data
-        if options.onlyamp:
-            data = dataAMP * ( np.cos(dataPH) + 1j*np.sin(dataPH) )
+        if sigmares > 0: stddev = max(np.round(stddev / sigmares), 1) * sigmares
+        bl_stddev[(ant1, ant2)] = stddev
+    return bl_stddev
+
+def firfilter(x, sigma, output=None):
+    """
+    Gaussian filter along axis 0 by direct convolution, the cost grows with sigma.
+    """
+    return gfilter(x, sigma, axis=0, truncate=truncate, output=output)
+
+# poles of the third order recursive Gaussian filter for sigma=2 (van Vliet, Young & Verbeek 1998)
+iir_poles = np.array([1.41650+1.00829j, 1.41650-1.00829j, 1.86543])
+
+def iir_coefficients(sigma):
+    """
+    Return the (b, a) coefficients for lfilter() of the recursive Gaussian
+    filter, with the poles scaled so that the causal plus anti-causal passes
+    have exactly a variance of sigma**2.
+    """
+    variance = lambda q: np.real(np.sum(2. * iir_poles**(1./q) / (iir_poles**(1./q) - 1.)**2)) - sigma**2
+    q = brentq(variance, 1.e-2, 10.*sigma + 10.)
+    a = np.real(np.poly(1. / iir_poles**(1./q)))
+    return np.array([np.sum(a)]), a
+
+def iirfilter(x, sigma, output=None):
+    """
+    Gaussian filter along axis 0 with a causal and an anti-causal recursive pass,
+    the cost per sample does not depend on sigma.
+    The edges are reflected as in gfilter(), over truncate*sigma samples.
+    """
+    b, a = iir_coefficients(sigma)
+    npad = int(truncate * sigma + 0.5)
+    y = np.pad(x, [(npad, npad)] + [(0, 0)] * (x.ndim - 1), mode='symmetric')
+    zi = lfilter_zi(b, a).reshape((-1,) + (1,) * (x.ndim - 1))
+    y, _ = lfilter(b, a, y, axis=0, zi=zi*y[:1])
+    y = y[::-1]
+    y, _ = lfilter(b, a, y, axis=0, zi=zi*y[:1])
+    if output is None:
+        return y[::-1][npad:len(y)-npad].astype(x.dtype)
+    output[...] = y[::-1][npad:len(y)-npad]
+    return output
+
+filters = {'fir': firfilter, 'iir': iirfilter}
+
+def smooth_baseline(data, weights, flags, stddev, onlyamp=False, backend='fir'):
+    """
+    Smooth the data and weights of a single baseline along the time axis (axis 0).
+    Returns the smoothed data and weights.
+    """
+    smoother = filters[backend]
+
+    flags[ np.isnan(data) ] = True # flag NaNs
+    weights[flags] = 0 # set weight of flagged data to 0
+    del flags
+
+    # Multiply every element of the data by the weights, convolve both the scaled data and the weights, and then
+    # divide the convolved data by the convolved weights (translating flagged data into weight=0). That's basically the equivalent of a
+    # running weighted average with a Gaussian window function.
+
+    # set bad data to 0 so nans do not propagate
+    data = np.nan_to_num(data*weights)
+
+    # smear weighted data and weights
+    if onlyamp:
+        dataAMP = smoother(np.abs(data), stddev)
+        dataPH = np.angle(data)
+    else:
+        dataR = smoother(np.real(data), stddev)
+        dataI = smoother(np.imag(data), stddev)
+
+    weights = smoother(weights, stddev)
+
+    # re-create data
+    if onlyamp:
+        data = dataAMP * ( np.cos(dataPH) + 1j*np.sin(dataPH) )
+    else:
+        data = (dataR + 1j * dataI)
+    data[(weights != 0)] /= weights[(weights != 0)] # avoid divbyzero
+
+    return data, weights
+
+def get_buffer(buffers, name, shape, dtype):
+    """
+    Return the array called name from the dict buffers, allocating it if it
+    does not exist yet or has a different shape.
+    """
+    buf = buffers.get(name)
+    if buf is None or buf.shape != shape:
+        buf = buffers[name] = np.empty(shape, dtype)
+    return buf
+
+def smooth_baseline_single(data, weights, flags, stddev, onlyamp=False, backend='fir', buffers=None):
+    """
+    Same as smooth_baseline(), but working in place in single precision: data must be
+    complex64 and weights float32 copies. The results are stored in the arrays of
+    the dict buffers, which are reused for the next baselines of the same shape
+    (new arrays are allocated if buffers is not given).
+    Returns the smoothed data and weights.
+    """
+    smoother = filters[backend]
+    if buffers is None: buffers = {}
+
+    flags |= np.isnan(data) # flag NaNs
+    weights[flags] = 0 # set weight of flagged data to 0
+
+    # set bad data to 0 so nans do not propagate
+    data *= weights
+    np.nan_to_num(data, copy=False)
+    del flags
+
+    # smear weighted data and weights
+    if onlyamp:
+        dataAMP = smoother(np.abs(data), stddev, get_buffer(buffers, 'amp', data.shape, np.float32))
+        dataPH = np.angle(data)
+        data = get_buffer(buffers, 'data', data.shape, np.complex64)
+        np.multiply(dataAMP, np.exp(1j*dataPH), out=data)
+    else:
+        # real and imaginary parts filtered at once, as interleaved float32
+        dataRI = smoother(data.view(np.float32), stddev, get_buffer(buffers, 'data', data.shape, np.complex64).view(np.float32))
+        data = dataRI.view(np.complex64)
+
+    weights = smoother(weights, stddev, get_buffer(buffers, 'weights', weights.shape, np.float32))
+
+    nonzero = (weights != 0)
+    data[nonzero] /= weights[nonzero] # avoid divbyzero
+
+    return data, weights
+
+def get_baseline_rows(a_ant1, a_ant2, bl_stddev, nant, maxbatch=0, a_time=None):
+    """
+    Return the rows of the baselines to smooth in a block of rows, as a list of (idx, stddev).
+    Baselines with the same sigma and number of rows are batched together, idx has
+    shape (nbaselines, nrows) with at most maxbatch baselines (if maxbatch > 0).
+    The rows of each baseline are in time order: the order of the block, or the
+    one of a_time if given (for blocks that are not time-sorted).
+    """
+    # one stable sort gives the rows of each baseline, still in time order
+    a_blid = a_ant1*nant + a_ant2
+    if a_time is None:
+        order = np.argsort(a_blid, kind='mergesort')
+    else:
+        order = np.lexsort((a_time, a_blid))
+    blids, starts = np.unique(a_blid[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+
+    batches = {}
+    for blid, start, end in zip(blids, starts, ends):
+        ant1, ant2 = blid // nant, blid % nant
+        if (ant1, ant2) not in bl_stddev: continue
+        batches.setdefault((bl_stddev[(ant1, ant2)], end-start), []).append(order[start:end])
+
+    bl_rows = []
+    for (stddev, nrows), idxs in sorted(batches.items()):
+        nbatch = maxbatch if maxbatch > 0 else len(idxs)
+        for i in range(0, len(idxs), nbatch):
+            bl_rows.append(( np.array(idxs[i:i+nbatch]), stddev ))
+    return bl_rows
+
+def smooth_rows(bl_rows, a_data, a_weights, a_flags, options):
+    """
+    Smooth in place the baselines listed in bl_rows (see get_baseline_rows()).
+    With options.check the result is compared to the one of the 'fir' backend
+    in double precision.
+    """
+    buffers = {}
+    for idx, stddev in bl_rows:
+        # (nrows, nbaselines, ...) arrays, so that time is the first axis for all baselines of the batch
+        idx = idx.T
+        if options.check:
+            refdata, refweights = smooth_baseline(a_data[idx].astype(np.complex128), a_weights[idx].astype(np.float64),
+                                                  a_flags[idx], stddev, options.onlyamp, 'fir')
+
+        if options.single:
+            data, weights = smooth_baseline_single(a_data[idx].astype(np.complex64, copy=False), a_weights[idx].astype(np.float32, copy=False),
+                                                   a_flags[idx], stddev, options.onlyamp, options.backend, buffers)
         else:
-            data = (dataR + 1j * dataI)
-        data[(weights != 0)] /= weights[(weights != 0)] # avoid divbyzero
-    
-        #print np.count_nonzero(data[~flags]), np.count_nonzero(data[flags]), 100*np.count_nonzero(data[flags])/np.count_nonzero(data)
-        #print "NANs in flagged data: ", np.count_nonzero(np.isnan(data[flags]))
-        #print "NANs in unflagged data: ", np.count_nonzero(np.isnan(data[~flags]))
-        #print "NANs in weights: ", np.count_nonzero(np.isnan(weights))
+            data, weights = smooth_baseline(a_data[idx], a_weights[idx], a_flags[idx], stddev, options.onlyamp, options.backend)
+
+        if options.check:
+            datadiff = np.nanmax(np.abs(data - refdata)) / np.nanmax(np.abs(refdata))
+            weightdiff = np.nanmax(np.abs(weights - refweights)) / np.nanmax(np.abs(refweights))
+            logging.info('%i baseline(s) with sigma=%.2f samples: max relative deviation from double precision fir: data = %.2e, weights = %.2e' % (idx.shape[1], stddev, datadiff, weightdiff))
 
         a_data[idx] = data
-        if options.weight: a_weights[idx] = weights
-    
-    #logging.info('Writing %s column.' % options.outcol)
-    ms_ant1.putcol(options.outcol, a_data)
+        a_weights[idx] = weights
+
+# shared-memory buffers of the parallel smoothing, set in the pool workers by init_worker()
+shared_buffers = None
+
+def get_readcol(options):
+    """
+    Return the column the unsmoothed data are read from: with options.direct
+    outcol was not filled and the data come straight from incol.
+    """
+    return options.incol if options.direct else options.outcol
+
+def make_shared_buffers(t, options, nrows):
+    """
+    Allocate shared-memory buffers for data, weights and flags of nrows rows.
+    """
+    buffers = []
+    for col in (get_readcol(options), 'WEIGHT_SPECTRUM', 'FLAG'):
+        cell = t.getcell(col, 0)
+        raw = multiprocessing.RawArray('b', int(nrows * cell.nbytes))
+        buffers.append((raw, cell.dtype, (int(nrows),) + cell.shape))
+    return buffers
+
+def get_shared_arrays(buffers, nrow):
+    """
+    Return numpy views on the first nrow rows of data, weights and flags buffers.
+    """
+    return [ np.frombuffer(raw, dtype=dtype).reshape(shape)[:nrow] for raw, dtype, shape in buffers ]
+
+def init_worker(buffers):
+    global shared_buffers
+    shared_buffers = buffers
+
+def smooth_rows_worker(args):
+    nrow, bl_rows, options = args
+    a_data, a_weights, a_flags = get_shared_arrays(shared_buffers, nrow)
+    smooth_rows(bl_rows, a_data, a_weights, a_flags, options)
+
+def read_block(t, options, buffers=None, startrow=0, nrow=-1):
+    """
+    Read data, weights and flags of a block of rows, directly in the shared-memory
+    buffers if given.
+    """
+    if buffers is None:
+        return [ t.getcol(col, startrow, nrow) for col in (get_readcol(options), 'WEIGHT_SPECTRUM', 'FLAG') ]
+    if nrow < 0: nrow = t.nrows() - startrow
+    arrays = get_shared_arrays(buffers, nrow)
+    for col, array in zip((get_readcol(options), 'WEIGHT_SPECTRUM', 'FLAG'), arrays):
+        t.getcolnp(col, array, startrow, nrow)
+    return arrays
+
+def smooth_block(a_ant1, a_ant2, a_data, a_weights, a_flags, bl_stddev, nant, options, pool=None, a_time=None):
+    """
+    Smooth in place all baselines contained in a block of rows.
+    If a pool of options.ncpu processes is given, the arrays must be the
+    shared-memory buffers of its workers and the baselines are smoothed in parallel.
+    If the block is not time-sorted, a_time gives the time of the rows.
+    """
+    if pool is None:
+        bl_rows = get_baseline_rows(a_ant1, a_ant2, bl_stddev, nant, a_time=a_time)
+        smooth_rows(bl_rows, a_data, a_weights, a_flags, options)
+    else:
+        # keep enough batches to feed all the workers
+        nbl = len(np.unique(a_ant1*nant + a_ant2))
+        bl_rows = get_baseline_rows(a_ant1, a_ant2, bl_stddev, nant, max(nbl // (4 * options.ncpu), 1), a_time)
+        nchunks = min(len(bl_rows), 4 * options.ncpu)
+        pool.map(smooth_rows_worker, [ (len(a_data), bl_rows[i::nchunks], options) for i in range(nchunks) ])
+
+def get_time_windows(times, ntimes, pad):
+    """
+    Split a time-ordered MS in windows of ntimes timeslots, each one padded with
+    pad timeslots on both sides.
+    Returns a list of (readstart, readend, writestart, writeend) row ranges.
+    """
+    first = np.concatenate(( np.where(np.diff(times) != 0)[0] + 1, [0, len(times)] ))
+    first.sort()
+    ntimeslots = len(first) - 1
+    windows = []
+    for t in range(0, ntimeslots, ntimes):
+        windows.append(( first[max(t-pad, 0)], first[min(t+ntimes+pad, ntimeslots)],
+                         first[t], first[min(t+ntimes, ntimeslots)] ))
+    return windows
+
+def smooth_ms_antennas(ms, options, bl_stddev, nant, timesorted=True):
+    """
+    Smooth the MS one ANTENNA1 at a time, reading all the timeslots at once.
+    If the MS is not time-sorted, each baseline is smoothed through its sort permutation.
+    """
+    buffers, pool = None, None
+    if options.ncpu > 1:
+        buffers = make_shared_buffers(ms, options, np.bincount(ms.getcol('ANTENNA1')).max())
+        pool = multiprocessing.Pool(options.ncpu, init_worker, (buffers,))
+
+    # iteration on antenna1
+    for ms_ant1 in ms.iter(["ANTENNA1"]):
+        ant1 = ms_ant1.getcol('ANTENNA1')[0]
+        logging.debug('Working on antenna: %s' % ant1)
+
+        a_data, a_weights, a_flags = read_block(ms_ant1, options, buffers)
+
+        a_time = None if timesorted else ms_ant1.getcol('TIME_CENTROID')
+        smooth_block(ms_ant1.getcol('ANTENNA1'), ms_ant1.getcol('ANTENNA2'), a_data, a_weights, a_flags,
+                     bl_stddev, nant, options, pool, a_time)
+
+        #logging.info('Writing %s column.' % options.outcol)
+        ms_ant1.putcol(options.outcol, a_data)
+
+        if options.weight:
+            #logging.warning('Writing WEIGHT_SPECTRUM column.')
+            ms_ant1.putcol('WEIGHT_SPECTRUM', a_weights)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+def smooth_ms_windows(ms, options, bl_stddev, nant):
+    """
+    Smooth the MS in overlapping time windows that fit in options.memory GB.
+    The windows are padded by the kernel half-width of the largest sigma, so
+    the result is the same as smoothing all timeslots at once (the MS must have
+    one row per baseline and timeslot, as written by NDPPP).
+    """
+    times = ms.getcol('TIME')
+    if np.any(np.diff(times) < 0):
+        logging.critical('The TIME column is not sorted, cannot use time windows.')
+        sys.exit(1)
+    nrows_time = np.count_nonzero(times == times[0])
+
+    # kernel half-width in timeslots
+    pad = int(truncate * max(bl_stddev.values()) + 0.5)
+    # bytes per row: data + weights + flags
+    cell = ms.getcell(get_readcol(options), 0)
+    bytes_row = cell.size * (cell.itemsize + 4 + 1)
+    ntimes = int(options.memory * 1024**3 / bytes_row / nrows_time) - 2*pad
+    if ntimes < 1:
+        ntimes = 1
+        logging.warning('Memory limit of %g GB is too small, using windows of 1 (+%i padding) timeslots.' % (options.memory, 2*pad))
+    windows = get_time_windows(times, ntimes, pad)
+    del times
+    logging.info('Smoothing in %i windows of %i (+%i padding) timeslots.' % (len(windows), ntimes, 2*pad))
+
+    buffers, pool = None, None
+    if options.ncpu > 1:
+        buffers = make_shared_buffers(ms, options, max(readend-readstart for readstart, readend, _, _ in windows))
+        pool = multiprocessing.Pool(options.ncpu, init_worker, (buffers,))
+
+    # rows that are overwritten by a window and read again (unsmoothed) by the next one
+    cache = None
+    for i, (readstart, readend, writestart, writeend) in enumerate(windows):
+        logging.debug('Working on rows: %i - %i' % (writestart, writeend))
+        nrow = readend - readstart
+        a_data, a_weights, a_flags = read_block(ms, options, buffers, readstart, nrow)
+        if cache is not None:
+            cachestart, c_data, c_weights = cache
+            a_data[cachestart-readstart:cachestart-readstart+len(c_data)] = c_data
+            a_weights[cachestart-readstart:cachestart-readstart+len(c_weights)] = c_weights
+        if i+1 < len(windows) and windows[i+1][0] < writeend:
+            cachestart = windows[i+1][0]
+            cache = (cachestart, a_data[cachestart-readstart:writeend-readstart].copy(),
+                     a_weights[cachestart-readstart:writeend-readstart].copy())
+
+        smooth_block(ms.getcol('ANTENNA1', readstart, nrow), ms.getcol('ANTENNA2', readstart, nrow),
+                     a_data, a_weights, a_flags, bl_stddev, nant, options, pool)
+
+        ms.putcol(options.outcol, a_data[writestart-readstart:writeend-readstart], writestart, writeend-writestart)
+        if options.weight:
+            ms.putcol('WEIGHT_SPECTRUM', a_weights[writestart-readstart:writeend-readstart], writestart, writeend-writestart)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+def get_layout_key(msfile):
+    """
+    Return a key that is the same for MSs with the same baseline lengths, i.e.
+    the subbands of an observation: antenna positions and time range.
+    """
+    ms = pt.table(msfile, ack=False)
+    anttab = pt.table(msfile + '/ANTENNA', ack=False)
+    key = (tuple(anttab.getcol('POSITION').flatten()),
+           ms.getcell('TIME', 0), ms.getcell('TIME', ms.nrows()-1), ms.nrows())
+    anttab.close()
+    ms.close()
+    return key
+
+def get_ms_baseline_lengths(msfile, options):
+    """
+    Return the baseline lengths of an MS, computed as set by options.bllength.
+    """
+    if options.bllength == 'antenna':
+        return get_antenna_baseline_lengths(msfile)
+    ms = pt.table(msfile, ack=False)
+    anttab = pt.table(msfile + '/ANTENNA', ack=False)
+    nant = anttab.nrows()
+    anttab.close()
+    maxrows = options.uvwrows if options.bllength == 'sample' else 0
+    bl_dist = get_baseline_lengths(ms, nant, maxrows=maxrows)
+    ms.close()
+    if maxrows > 0:
+        # baselines that are not in the sampled rows (e.g. in a baseline-ordered MS)
+        # get the length from the antenna positions, so that they are still smoothed
+        missing = [ (ant1, ant2) for ant1 in range(nant) for ant2 in range(ant1+1, nant)
+                    if (ant1, ant2) not in bl_dist and (ant2, ant1) not in bl_dist ]
+        if len(missing) > 0:
+            logging.warning('%i baseline(s) not found in the sampled UVW rows of %s, using their length from the antenna positions.' % (len(missing), msfile))
+            ant_dist = get_antenna_baseline_lengths(msfile)
+            for ant1, ant2 in missing:
+                bl_dist[(ant1, ant2)] = bl_dist[(ant2, ant1)] = ant_dist[(ant1, ant2)]
+    return bl_dist
+
+def baseline_lengths_worker(args):
+    return get_ms_baseline_lengths(*args)
+
+def smooth_ms(msfile, options, bl_dist=None):
+    """
+    Smooth one MS. The baseline lengths bl_dist are computed from the MS if not given.
+    """
+    logging.info('Smoothing: %s' % msfile)
+    # open input/output MS
+    ms = pt.table(msfile, readonly=False, ack=False)
+
+    freqtab = pt.table(msfile + '/SPECTRAL_WINDOW', ack=False)
+    freq = freqtab.getcol('REF_FREQUENCY')[0]
+    freqtab.close()
+    wav = 299792458. / freq
+    timepersample = ms.getcell('INTERVAL',0)
+    anttab = pt.table(msfile + '/ANTENNA', ack=False)
+    nant = anttab.nrows()
+    anttab.close()
+
+    # check if ms is time-ordered
+    timesorted = is_time_sorted(ms)
+    if not timesorted:
+        logging.warning('MS is not time-sorted, the rows of each baseline will be sorted before smoothing.')
+
+    # create column to smooth
+    direct = options.direct and options.smooth != 'False'
+    addcol(ms, options.incol, options.outcol, copy=not direct)
+    # if smoothing should not be performed
+    if options.smooth == 'False':
+        ms.close()
+        return
+
+    # retore WEIGHT_SPECTRUM
+    if 'WEIGHT_SPECTRUM_ORIG' in ms.colnames() and options.restore:
+        addcol(ms, 'WEIGHT_SPECTRUM_ORIG', 'WEIGHT_SPECTRUM')
+    # backup WEIGHT_SPECTRUM
+    elif options.weight and not options.nobackup:
+        addcol(ms, 'WEIGHT_SPECTRUM', 'WEIGHT_SPECTRUM_ORIG')
+
+    if bl_dist is None:
+        bl_dist = get_ms_baseline_lengths(msfile, options)
+    bl_stddev = get_baseline_sigmas(bl_dist, freq, timepersample, options.ionfactor, options.bscalefactor, options.sigmares)
+
+    if len(bl_stddev) == 0:
+        logging.warning('No baselines to smooth.')
+        if direct: addcol(ms, options.incol, options.outcol)
+    elif options.memory > 0 and timesorted:
+        smooth_ms_windows(ms, options, bl_stddev, nant)
+    else:
+        if options.memory > 0:
+            logging.warning('Time windows need a time-sorted MS, reading all the timeslots of an antenna at once.')
+        smooth_ms_antennas(ms, options, bl_stddev, nant, timesorted)
+
+    ms.close()
+
+def smooth_ms_worker(args):
+    msfile, options, bl_dist = args
+    try:
+        smooth_ms(msfile, options, bl_dist)
+        return True
+    except (Exception, SystemExit) as e:
+        logging.error('Smoothing of %s failed: %s' % (msfile, str(e)))
+        return False
+
+def smooth_mslist(mslist, options):
+    """
+    Smooth many MSs with a pool of options.ncpu processes, one MS per process.
+    The baseline lengths are computed once for all MSs with the same layout,
+    options.memory is shared among the processes.
+    Returns True if all MSs were smoothed.
+    """
+    njobs = min(options.ncpu, len(mslist))
+    ms_options = copy.copy(options)
+    ms_options.ncpu = 1
+    ms_options.memory = options.memory / njobs
+    pool = multiprocessing.Pool(njobs)
+
+    bl_dists = {}
+    if options.smooth != 'False':
+        keys = pool.map(get_layout_key, mslist)
+        layouts = sorted(set(keys))
+        logging.info('Computing the baseline lengths of %i layout(s).' % len(layouts))
+        bl_dists = dict(zip(layouts, pool.map(baseline_lengths_worker, [ (mslist[keys.index(key)], options) for key in layouts ])))
+        bl_dists = dict( (msfile, bl_dists[key]) for msfile, key in zip(mslist, keys) )
+
+    logging.info('Smoothing %i MSs with %i processes.' % (len(mslist), njobs))
+    results = pool.map(smooth_ms_worker, [ (msfile, ms_options, bl_dists.get(msfile)) for msfile in mslist ], chunksize=1)
+    pool.close()
+    pool.join()
+    return all(results)
+
+if __name__ == '__main__':
+    opt = optparse.OptionParser(usage="%prog [options] MS [MS ...]", version="%prog 0.1")
+    opt.add_option('-f', '--ionfactor', help='Gives an indication on how strong is the ionosphere [default: 0.2]', type='float', default=0.2)
+    opt.add_option('-s', '--bscalefactor', help='Gives an indication on how the smoothing varies with BL-lenght [default: 0.5]', type='float', default=0.5)
+    opt.add_option('-i', '--incol', help='Column name to smooth [default: DATA]', type='string', default='DATA')
+    opt.add_option('-o', '--outcol', help='Output column [default: SMOOTHED_DATA]', type="string", default='SMOOTHED_DATA')
+    opt.add_option('-w', '--weight', help='Save the newly computed WEIGHT_SPECTRUM, this action permanently modify the MS! [default: False]', action="store_true", default=False)
+    opt.add_option('-r', '--restore', help='If WEIGHT_SPECTRUM_ORIG exists then restore it before smoothing [default: False]', action="store_true", default=False)
+    opt.add_option('-b', '--nobackup', help='Do not backup the old WEIGHT_SPECTRUM in WEIGHT_SPECTRUM_ORIG [default: do backup if -w]', action="store_true", default=False)
+    opt.add_option('-a', '--onlyamp', help='Smooth only amplitudes [default: smooth real/imag]', action="store_true", default=False)
+    opt.add_option('-S', '--smooth', help='Performs smoothing (otherwise column will be only copied)', type="string", default=True)
+    opt.add_option('-m', '--memory', help='Process the MSs in time windows using at most this amount of memory in GB in total, -1 for the memory budget of the job [default: 0, read all timeslots of an antenna at once]', type='float', default=0.)
+    opt.add_option('-n', '--ncpu', help='Number of processes that smooth baselines, or MSs if more than one is given, in parallel, 0 for the CPU budget of the job [default: 1]', type='int', default=1)
+    opt.add_option('-B', '--backend', help='Gaussian filter: "fir" (convolution, cost grows with sigma) or "iir" (recursive, cost independent of sigma) [default: fir]', type='choice', choices=['fir', 'iir'], default='fir')
+    opt.add_option('-c', '--check', help='Log the deviation of every smoothed baseline from the "fir" backend in double precision [default: False]', action="store_true", default=False)
+    opt.add_option('-R', '--sigmares', help='Round the sigmas to a multiple of this number of samples, to filter baselines with the same sigma together [default: 0, no rounding]', type='float', default=0.)
+    opt.add_option('-d', '--direct', help='Do not copy incol to outcol before smoothing, write all rows of outcol during the smoothing instead [default: False]', action="store_true", default=False)
+    opt.add_option('-L', '--bllength', help='Baseline lengths from: "uvw" (mean of the UVW column), "sample" (mean of a sample of UVW rows) or "antenna" (antenna positions) [default: uvw]', type='choice', choices=['uvw', 'sample', 'antenna'], default='uvw')
+    opt.add_option('-U', '--uvwrows', help='Maximum number of UVW rows read with --bllength sample [default: 100000]', type='int', default=100000)
+    opt.add_option('-P', '--single', help='Smooth in single precision, in place and with reused buffers [default: False]', action="store_true", default=False)
+    opt.add_option('-M', '--mapfile', help='Smooth the MSs of this mapfile (besides the ones given as arguments)', type='string', default=None)
+    (options, mslist) = opt.parse_args()
+
+    if options.mapfile is not None:
+        from lofarpipe.support.data_map import DataMap
+        mslist += [ item.file for item in DataMap.load(options.mapfile) if not item.skip ]
+
+    if mslist == []:
+        opt.print_help()
+        sys.exit(0)
+
+    for msfile in mslist:
+        if not os.path.exists(msfile):
+            logging.error("Cannot find MS file: %s" % msfile)
+            sys.exit(1)
+
+    if options.uvwrows < 10:
+        logging.error('The number of sampled UVW rows (--uvwrows) must be at least 10.')
+        sys.exit(1)
+
+    if options.ncpu < 1:
+        options.ncpu = resource_budget.get_cpu_budget()
+        logging.info('Using the CPU budget of the job: %i processes.' % options.ncpu)
+    if options.memory < 0:
+        options.memory = resource_budget.get_memory_budget() / 1024.**3
+        logging.info('Using the memory budget of the job: %.2f GB.' % options.memory)
 
-    if options.weight:
-        #logging.warning('Writing WEIGHT_SPECTRUM column.')
-        ms_ant1.putcol('WEIGHT_SPECTRUM', a_weights)
+    if len(mslist) == 1:
+        smooth_ms(mslist[0], options)
+    elif not smooth_mslist(mslist, options):
+        sys.exit(1)
 
-ms.close()
-logging.info("Done.")
+    logging.info("Done.")
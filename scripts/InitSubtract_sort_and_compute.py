@@ -4,9 +4,124 @@ Script to sort a list of MSs into frequency-bands, and compute additional values
 """
 import pyrap.tables as pt
 import os
+import sys
 import numpy as np
 from lofarpipe.support.data_map import DataMap
 from lofarpipe.support.data_map import DataProduct
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ms_catalog
+import image_sizes
+
+# summed elevation and number of samples per observation (see get_mean_elevation)
+elevation_cache = {}
+
+def itrf_to_geodetic(xyz):
+    """
+    Convert ITRF positions (shape (..., 3), in m) to WGS84 longitude and latitude in rad
+    """
+    a = 6378137.0
+    f = 1.0 / 298.257223563
+    b = a * (1.0 - f)
+    e2 = f * (2.0 - f)
+    ep2 = e2 / (1.0 - e2)
+    x, y, z = xyz[..., 0], xyz[..., 1], xyz[..., 2]
+    lon = np.arctan2(y, x)
+    p = np.hypot(x, y)
+    # Bowring's formula, accurate to well below a mas on the Earth's surface
+    theta = np.arctan2(z * a, p * b)
+    lat = np.arctan2(z + ep2 * b * np.sin(theta)**3, p - e2 * a * np.cos(theta)**3)
+    return lon, lat
+
+def get_elevation(time, ra, dec, lon, lat):
+    """
+    Return the elevation in rad of a J2000 direction at the given times and positions
+
+    The direction is precessed to the mean equator of date (IAU 1976) and the
+    hour angle is taken from the mean sidereal time (IAU 1982). Nutation,
+    aberration and refraction are ignored, which keeps the result within a few
+    tens of arcsec of casacore's AZEL (i.e. of mscal.azel1()).
+
+    Parameters
+    ----------
+    time : array
+        UTC in MJD seconds (the MS TIME column)
+    ra, dec : float
+        J2000 direction in rad
+    lon, lat : array
+        Geodetic longitude and latitude in rad, broadcastable with time
+    """
+    jd = np.asarray(time) / 86400.0 + 2400000.5
+    T = (jd - 2451545.0) / 36525.0
+    arcsec = np.pi / 180.0 / 3600.0
+    zeta = (2306.2181 * T + 0.30188 * T**2 + 0.017998 * T**3) * arcsec
+    z = (2306.2181 * T + 1.09468 * T**2 + 0.018203 * T**3) * arcsec
+    theta = (2004.3109 * T - 0.42665 * T**2 - 0.041833 * T**3) * arcsec
+    A = np.cos(dec) * np.sin(ra + zeta)
+    B = np.cos(theta) * np.cos(dec) * np.cos(ra + zeta) - np.sin(theta) * np.sin(dec)
+    C = np.sin(theta) * np.cos(dec) * np.cos(ra + zeta) + np.cos(theta) * np.sin(dec)
+    ra_date = np.arctan2(A, B) + z
+    dec_date = np.arcsin(np.clip(C, -1.0, 1.0))
+    gmst_sec = (67310.54841 + (876600.0 * 3600.0 + 8640184.812866) * T
+                + 0.093104 * T**2 - 6.2e-6 * T**3)
+    gmst = np.mod(gmst_sec, 86400.0) / 86400.0 * 2.0 * np.pi
+    hour_angle = gmst + lon - ra_date
+    return np.arcsin(np.clip(np.sin(lat) * np.sin(dec_date)
+                             + np.cos(lat) * np.cos(dec_date) * np.cos(hour_angle), -1.0, 1.0))
+
+def get_mean_elevation(mslist, rowincr=10000):
+    """
+    Return the mean elevation in rad of the phase center over a list of MSs
+
+    Like the TaQL query "SELECT mscal.azel1()[1] FROM ms LIMIT ::rowincr" on
+    every MS, the elevation is evaluated for every rowincr-th row at the
+    position of ANTENNA1 and averaged over all MSs. It is computed with
+    get_elevation() for the unique timestamps and stations of these rows only,
+    and cached per observation (time range, number of rows and pointing), so
+    that the other bands of the same observation don't need to read the MS.
+
+    Parameters
+    ----------
+    mslist : list of str
+        MSs to average over
+    rowincr : int, optional
+        Row increment of the samples
+    """
+    el_sum = 0.
+    el_count = 0
+    for ms in mslist:
+        tab = pt.table(ms, ack=False)
+        nrows = tab.nrows()
+        field = pt.table(ms+'::FIELD', ack=False)
+        phase_dir = field.getcol('PHASE_DIR')[:, 0, :]
+        field.close()
+        obs = pt.table(ms+'::OBSERVATION', ack=False)
+        if obs.nrows() > 0:
+            key = (tuple(np.round(obs.getcol('TIME_RANGE')[0], 3)), nrows,
+                   tuple(np.round(phase_dir.flatten(), 9)))
+        else:
+            key = (os.path.abspath(ms), nrows)
+        obs.close()
+        if key not in elevation_cache:
+            times = tab.getcol('TIME', rowincr=rowincr)
+            ant1 = tab.getcol('ANTENNA1', rowincr=rowincr)
+            field_ids = tab.getcol('FIELD_ID', rowincr=rowincr)
+            ant = pt.table(ms+'::ANTENNA', ack=False)
+            lon, lat = itrf_to_geodetic(ant.getcol('POSITION'))
+            ant.close()
+            elevation = np.zeros(len(times))
+            for field_id in np.unique(field_ids):
+                sel = (field_ids == field_id)
+                # evaluate every unique timestamp once for every unique station
+                utimes, time_idx = np.unique(times[sel], return_inverse=True)
+                uants, ant_idx = np.unique(ant1[sel], return_inverse=True)
+                el_grid = get_elevation(utimes[:, np.newaxis], phase_dir[field_id, 0], phase_dir[field_id, 1],
+                                        lon[uants][np.newaxis, :], lat[uants][np.newaxis, :])
+                elevation[sel] = el_grid[time_idx, ant_idx]
+            elevation_cache[key] = (np.sum(elevation), len(elevation))
+        tab.close()
+        el_sum += elevation_cache[key][0]
+        el_count += elevation_cache[key][1]
+    return el_sum / el_count
 
 class Band(object):
     """
@@ -17,17 +132,14 @@ class Band(object):
         self.msnames = [ MS.split('/')[-1] for MS in self.files ]
         self.numMS = len(self.files)
         # Get the frequency info and set name
-        sw = pt.table(self.files[0]+'::SPECTRAL_WINDOW', ack=False)
-        self.freq = sw.col('REF_FREQUENCY')[0]
-        self.nchan = sw.col('NUM_CHAN')[0]
-        self.chan_freqs_hz = sw.col('CHAN_FREQ')[0]
-        self.chan_width_hz = sw.col('CHAN_WIDTH')[0][0]
-        sw.close()
+        metadata = ms_catalog.get_ms_metadata(self.files[0])
+        self.freq = metadata['ref_freq']
+        self.nchan = metadata['nchan']
+        self.chan_freqs_hz = metadata['chan_freq']
+        self.chan_width_hz = metadata['chan_width'][0]
         self.name = str(int(self.freq/1e6))
         # Get the station diameter
-        ant = pt.table(self.files[0]+'::ANTENNA', ack=False)
-        self.diam = float(ant.col('DISH_DIAMETER')[0])
-        ant.close()
+        self.diam = metadata['dish_diameter']
 
 
 
@@ -55,16 +167,8 @@ class Band(object):
         if cellsize_lowres_deg:
             self.cellsize_lowres_deg = cellsize_lowres_deg
         if not hasattr(self, 'mean_el_rad'):
-            for MS_id in xrange(self.numMS):
-                # calculate mean elevation
-                tab = pt.table(self.files[MS_id], ack=False)
-                el_values = pt.taql("SELECT mscal.azel1()[1] AS el from "
-                                    + self.files[MS_id] + " limit ::10000").getcol("el")
-                if MS_id == 0:
-                    global_el_values = el_values
-                else:
-                    global_el_values = np.hstack( (global_el_values, el_values ) )
-            self.mean_el_rad = np.mean(global_el_values)
+            # calculate mean elevation
+            self.mean_el_rad = get_mean_elevation(self.files)
 
         # Calculate mean FOV
         sec_el = 1.0 / np.sin(self.mean_el_rad)
@@ -77,9 +181,7 @@ class Band(object):
 
     def get_optimum_size(self, size):
         """
-        Gets the nearest optimum image size
-
-        Taken from the casa source code (cleanhelper.py)
+        Gets the nearest optimum image size (see image_sizes.get_optimum_size)
 
         Parameters
         ----------
@@ -92,63 +194,36 @@ class Band(object):
             Optimum image size nearest to target size
 
         """
-        import numpy
-
-        def prime_factors(n, douniq=True):
-            """ Return the prime factors of the given number. """
-            factors = []
-            lastresult = n
-            sqlast=int(numpy.sqrt(n))+1
-            if n == 1:
-                return [1]
-            c=2
-            while 1:
-                 if (lastresult == 1) or (c > sqlast):
-                     break
-                 sqlast=int(numpy.sqrt(lastresult))+1
-                 while 1:
-                     if(c > sqlast):
-                         c=lastresult
-                         break
-                     if lastresult % c == 0:
-                         break
-                     c += 1
-                 factors.append(c)
-                 lastresult /= c
-            if (factors==[]): factors=[n]
-            return  numpy.unique(factors).tolist() if douniq else factors
-
-        n = int(size)
-        if (n%2 != 0):
-            n+=1
-        fac=prime_factors(n, False)
-        for k in range(len(fac)):
-            if (fac[k] > 7):
-                val=fac[k]
-                while (numpy.max(prime_factors(val)) > 7):
-                    val +=1
-                fac[k]=val
-        newlarge=numpy.product(fac)
-        for k in range(n, newlarge, 2):
-            if ((numpy.max(prime_factors(k)) < 8)):
-                return k
-        return newlarge
-
-    def get_averaging_steps(self):
+        return image_sizes.get_optimum_size(size)
+
+    def get_averaging_steps(self, nsample=10000):
         """
         Sets the averaging step sizes
 
         Note: the frequency step must be an even divisor of the number of
         channels
 
+        Parameters
+        ----------
+        nsample : int, optional
+            Number of rows used to check the INTERVAL of the first MS
+
         """
-        # Get time per sample and number of samples
+        # Get time per sample from the INTERVAL of the first row, and check it
+        # against the time to the next sample of the same baseline in the first rows
         t = pt.table(self.files[0], readonly=True, ack=False)
-        for t2 in t.iter(["ANTENNA1","ANTENNA2"]):
-            if (t2.getcell('ANTENNA1',0)) < (t2.getcell('ANTENNA2',0)):
-                self.timestep_sec = t2[1]['TIME']-t2[0]['TIME'] # sec
-                break
+        self.timestep_sec = t.getcell('INTERVAL', 0) # sec
+        nrows = min(t.nrows(), nsample)
+        times = t.getcol('TIME', 0, nrows)
+        ant1 = t.getcol('ANTENNA1', 0, nrows)
+        ant2 = t.getcol('ANTENNA2', 0, nrows)
         t.close()
+        next_sample = np.where((ant1 == ant1[0]) & (ant2 == ant2[0]) & (times != times[0]))[0]
+        if len(next_sample) > 0:
+            time_diff = times[next_sample[0]] - times[0]
+            if abs(time_diff - self.timestep_sec) > 1.e-3 * self.timestep_sec:
+                print "InitSubtract_sort_and_compute.py: INTERVAL of",self.timestep_sec,"s does not match the time between samples of",time_diff,"s, using the latter."
+                self.timestep_sec = time_diff
         # generate a (numpy-)array with the divisors of nchan
         tmp_divisors = []
         for step in range(self.nchan,0,-1):
@@ -264,11 +339,9 @@ def main(ms_input, outmapname=None, mapfile_dir=None, cellsize_highres_deg=0.002
     apply_y_axis_stretch_lowres = input2bool(apply_y_axis_stretch_lowres)
 
     msdict = {}
-    for ms in ms_list:
+    for ms, metadata in zip(ms_list, ms_catalog.get_metadata(ms_list)):
         # group all MSs by frequency
-        sw = pt.table(ms+'::SPECTRAL_WINDOW', ack=False)
-        msfreq = int(sw.col('REF_FREQUENCY')[0])
-        sw.close()
+        msfreq = int(metadata['ref_freq'])
         if msfreq in msdict:
             msdict[msfreq].append(ms)
         else:
@@ -5,7 +5,11 @@ import re
 import pyrap.tables as pt
 import numpy
 import os
+import shutil
+import multiprocessing
 from lofarpipe.support.data_map import DataMap, DataProduct
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import resource_budget
 
 global_limit = 637871244
 ########################################################################
@@ -28,10 +32,12 @@ def input2strlist_nomapfile(invar):
 
 ########################################################################
 def getsystemmemory():
-   
-   memory = int(os.popen('cat /proc/meminfo | grep MemAvailable').readlines()[0].split(':')[-1].split()[0])
+   """
+   Memory budget of the job in kB, i.e. the available memory of the host
+   limited by the cgroup and SLURM allocation (see resource_budget.py)
+   """
+   memory = int(resource_budget.get_memory_budget() / 1024)
    return memory
-   pass
 
 ########################################################################
 def getfilesize(MS):
@@ -42,7 +48,121 @@ def getfilesize(MS):
    pass
 
 ########################################################################
-def main(ms_input, ms_output, min_length, overhead = 0.8, filename=None, mapfile_dir=None):
+def getmssize(MS):
+   """
+   Estimate the in-memory footprint of the visibility data of an MS in kB
+
+   The estimate is rows x channels x correlations x bytes per element,
+   summed over all columns that hold one value per channel and correlation
+   (DATA, FLAG, WEIGHT_SPECTRUM, ...). Unlike the size on disk, it does not
+   depend on storage managers or compression. Falls back to the disk usage
+   if the table metadata cannot be read.
+   """
+   elementsize = {'boolean': 1, 'short': 2, 'int': 4, 'float': 4, 'double': 8,
+                  'complex': 8, 'dcomplex': 16}
+   try:
+       t      = pt.table(MS, ack=False)
+       shape  = list(t.getcoldesc('DATA').get('shape', []))
+       if not shape and t.nrows() > 0:
+           shape = list(t.getcell('DATA', 0).shape)
+       nbytes = 0
+       for col in t.colnames():
+           desc = t.getcoldesc(col)
+           if desc.get('ndim', 0) != 2 or desc['valueType'] not in elementsize:
+               continue
+           if 'shape' in desc and list(desc['shape']) != shape:
+               continue
+           nbytes += elementsize[desc['valueType']]
+       size = t.nrows() * numpy.prod(shape) * nbytes
+       t.close()
+   except RuntimeError:
+       return getfilesize(MS)
+   return int(size / 1024.) + 1
+
+########################################################################
+def count_chunks(sizes, max_size):
+   """
+   Number of contiguous chunks needed if the files are packed in order
+   without any chunk exceeding max_size (a single file larger than
+   max_size ends up in a chunk of its own)
+   """
+   nchunks = 1
+   current = 0
+   for size in sizes:
+       if current > 0 and current + size > max_size:
+           nchunks += 1
+           current = 0
+       current += size
+   return nchunks
+
+########################################################################
+def plan_chunks(sizes, max_size):
+   """
+   Split a list of file sizes into contiguous chunks that fit into max_size
+
+   Uses as few chunks as possible (a single file larger than max_size gets a
+   chunk of its own) and among those splits picks the one with the longest
+   shortest chunk, so that min_length is met whenever possible. Ties are
+   broken by the smallest largest chunk.
+
+   Parameters
+   ----------
+   sizes : list of int
+       Size of every file, in the order they should be concatenated
+   max_size : int
+       Memory budget of a single chunk, in the same units as sizes
+
+   Returns
+   -------
+   set_ranges : list of int
+       Boundaries of the chunks, i.e. chunk i is [set_ranges[i]:set_ranges[i + 1]]
+   """
+   nfiles  = len(sizes)
+   nchunks = count_chunks(sizes, max_size)
+   cumsize = numpy.concatenate(([0], numpy.cumsum(sizes)))
+
+   # best[i] = (shortest chunk, -largest chunk, boundaries) for files [0:i]
+   best = {0: (nfiles, 0, [0])}
+   for k in range(nchunks):
+       new_best = {}
+       for i in range(1, nfiles + 1):
+           for start in best:
+               if start >= i:
+                   continue
+               size = cumsize[i] - cumsize[start]
+               if size > max_size and i - start > 1:
+                   continue
+               shortest, largest, ranges = best[start]
+               score = (min(shortest, i - start), min(largest, -size))
+               if i not in new_best or score > new_best[i][:2]:
+                   new_best[i] = score + (ranges + [i],)
+       best = new_best
+   return best[nfiles][2]
+
+########################################################################
+def remove_output(outname):
+   """
+   Remove a (partially) concatenated MS and the helper table of msconcat
+   """
+   for f in [outname, outname + '_CONCAT']:
+       if os.path.exists(f):
+           shutil.rmtree(f)
+
+########################################################################
+def concat_chunk(args):
+   """
+   Concatenate one chunk of MSs, removing the partial output if this fails
+   """
+   files, outname = args
+   try:
+       pt.msconcat(files, outname)
+   except:
+       remove_output(outname)
+       raise
+   return outname
+
+########################################################################
+def main(ms_input, ms_output, min_length, overhead = 0.8, filename=None, mapfile_dir=None, ncpu=1):
 
     """
     Virtually concatenate subbands
@@ -61,53 +181,64 @@ def main(ms_input, ms_output, min_length, overhead = 0.8, filename=None, mapfile
         Name of output mapfile
     mapfile_dir : str
         Directory for output mapfile
+    ncpu : int
+        Number of chunks to concatenate in parallel
 
     """
     system_memory = getsystemmemory()
     filelist      = input2strlist_nomapfile(ms_input)
-    file_size     = getfilesize(filelist[0])
+    file_sizes    = [getmssize(ms) for ms in filelist]
     overhead      = float(overhead)
 
     print "Detected available system memory is: " + str(int(((system_memory / 1024. / 1024.) + 0.5))) + " GB" 
-    #print "Detected file size is: " + str(int(((file_size / 1024. / 1024.) + 0.5))) + " GB" 
+    print "Estimated total data size is: " + str(int(((sum(file_sizes) / 1024. / 1024.) + 0.5))) + " GB" 
     if overhead * system_memory > global_limit:
         system_memory = global_limit
         overhead      = 1.0
         print "Number of files to concat will be limited to the global limit of: " + str(int(((global_limit / 1024. / 1024.) + 0.5))) + " GB" 
         pass    
-    
-    #i = 1
-    max_space     = overhead * system_memory / file_size
-    max_length    = len(filelist) / int((len(filelist) / max_space) + 1.)
-
-    #while max_length * file_size > overhead * system_memory:
-        #i += 1
-        #max_length = len(filelist) / ((len(filelist) / max_space) + i)
-        #pass
-    
-    if max_length >= int(min_length):
+
+    set_ranges = plan_chunks(file_sizes, overhead * system_memory)
+    lengths    = numpy.diff(set_ranges)
+
+    if min(lengths) >= int(min_length):
         memory = '-memory-read'
         pass
     else:
         memory = '-indirect-read'
-        max_length = len(filelist)
-        if max_length * file_size > global_limit:
-            max_space  = global_limit / file_size
-            max_length = len(filelist) / int((len(filelist) / max_space) + 1.)
+        set_ranges = plan_chunks(file_sizes, global_limit)
+        lengths    = numpy.diff(set_ranges)
+        if len(lengths) > 1:
             print "Number of files to concat was limited to the global limit of: " + str(int(((global_limit / 1024. / 1024.) + 0.5))) + " GB" 
             print "WARNING: The number of concatenated files will thus be lower than the min_length of: "  + str(min_length)
             pass
         pass
     
     print "Applying an overhead of: " + str(overhead)
-    print "The max_length value is: " + str(max_length)
-    set_ranges     = list(numpy.arange(0, len(filelist) + 1, int(max_length)))
-    set_ranges[-1] = len(filelist)
+    print "The number of files per chunk is: " + ', '.join([str(length) for length in lengths])
+
+    chunks = [(filelist[set_ranges[i]:set_ranges[i + 1]], ms_output + '_' + str(i))
+              for i in range(len(set_ranges) - 1)]
+    ncpu   = max(1, min(int(ncpu), len(chunks), resource_budget.get_cpu_budget()))
+    pool   = None
+    try:
+        if ncpu > 1:
+            pool    = multiprocessing.Pool(ncpu)
+            outputs = pool.map(concat_chunk, chunks)
+            pool.close()
+            pool.join()
+        else:
+            outputs = [concat_chunk(chunk) for chunk in chunks]
+    except:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        for files, f in chunks:
+            remove_output(f)
+        raise
 
     map_out = DataMap([])
-    for i in numpy.arange(len(set_ranges) - 1):
-        f = ms_output + '_' + str(i)
-        pt.msconcat(filelist[set_ranges[i]:set_ranges[i + 1]], f)
+    for f in outputs:
         map_out.data.append(DataProduct('localhost', f, False))
 
     fileid = os.path.join(mapfile_dir, filename)
@@ -129,9 +260,11 @@ if __name__ == '__main__':
                         help='Minimum amount of subbands to concatenate in frequency.')
     parser.add_argument('--overhead', type=float, default=0.8,
                         help='Only use this fraction of the available memory for deriving the amount of data to be concatenated.')
+    parser.add_argument('--ncpu', type=int, default=1,
+                        help='Number of chunks to concatenate in parallel.')
 
 
 
     args = parser.parse_args()
 
-    main(args.MSfile,args.MSout,args.min_length,args.overhead)
+    main(args.MSfile,args.MSout,args.min_length,args.overhead,ncpu=args.ncpu)
@@ -8,10 +8,11 @@ from astropy.io import fits
 from astropy import wcs
 import numpy as np
 import scipy.interpolate
-import casacore.tables as pt
 import sys
 import os
 import glob
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ms_catalog
 
 
 def ra2hhmmss(deg):
@@ -94,11 +95,10 @@ def main(fits_models, ms_file, skymodel, fits_masks, min_flux_jy=0.005, interp='
         files = ms_file.strip('[] ').split(',')
         #files = [f.strip() for f in files]
         ms_file = files[0].strip('\'\" ')
-    sw = pt.table(ms_file+'::SPECTRAL_WINDOW', ack=False)
-    ms_freq = sw.col('REF_FREQUENCY')[0]
-    ms_freq_low = sw.col('CHAN_FREQ')[0][0]
-    ms_freq_high = sw.col('CHAN_FREQ')[0][-1]
-    sw.close()
+    metadata = ms_catalog.get_ms_metadata(ms_file)
+    ms_freq = metadata['ref_freq']
+    ms_freq_low = metadata['chan_freq'][0]
+    ms_freq_high = metadata['chan_freq'][-1]
 
     # Get frequencies and data of model images and masks
     freqs = []
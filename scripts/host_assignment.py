@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Assign groups of files to hosts, preferring the host that stores the files
+
+Where a file is stored is judged, in this order, from:
+  - a host -> mount map, e.g. {'node01': ['/data1', '/data2'], 'node02': ['/data3']}
+    (the longest matching mount wins),
+  - the host of the file in an input mapfile,
+  - a host name that is a component of the path, e.g. /net/node01/data/L123_SB000.MS
+Files on unknown hosts do not favour any host.
+
+The groups are placed, largest first, on the host that stores most of their
+bytes among the hosts that stay within the balanced load (the total input size
+divided by the number of hosts, plus a tolerance). If no host has room left,
+the least loaded hosts are considered instead.
+"""
+import os
+
+########################################################################
+def parse_host_mounts(host_mounts):
+    """
+    Convert a host -> mount map given as a string "host1:/mnt/a,/mnt/b;host2:/mnt/c"
+    (or already as a dict) into a dict of lists
+    """
+    if not host_mounts:
+        return {}
+    if isinstance(host_mounts, dict):
+        return dict((host, [mounts] if isinstance(mounts, str) else list(mounts))
+                    for host, mounts in host_mounts.items())
+    result = {}
+    for entry in str(host_mounts).strip('[]{} ').split(';'):
+        if ':' not in entry:
+            continue
+        host, mounts = entry.split(':', 1)
+        result[host.strip(' \'\"')] = [m.strip(' \'\"') for m in mounts.split(',') if m.strip(' \'\"')]
+    return result
+
+########################################################################
+def get_file_host(fname, hosts, file_hosts=None, host_mounts=None):
+    """
+    Return the host (out of hosts) that stores fname, or None if unknown
+
+    Parameters
+    ----------
+    fname : str
+        Path of the file
+    hosts : list of str
+        Hosts to choose from
+    file_hosts : dict, optional
+        Host of every file, e.g. from an input mapfile
+    host_mounts : dict or str, optional
+        Host -> mount map (see parse_host_mounts)
+    """
+    path = os.path.abspath(fname)
+    best = None
+    best_length = -1
+    for host, mounts in parse_host_mounts(host_mounts).items():
+        for mount in mounts:
+            mount = os.path.abspath(mount).rstrip('/')
+            if (path == mount or path.startswith(mount + '/')) and len(mount) > best_length and host in hosts:
+                best, best_length = host, len(mount)
+    if best is not None:
+        return best
+    if file_hosts and file_hosts.get(fname) in hosts:
+        return file_hosts[fname]
+    components = path.split('/')
+    for host in hosts:
+        if host in components or host.split('.')[0] in components:
+            return host
+    return None
+
+########################################################################
+def get_size(fname):
+    """
+    Return the size of a file or of the files at the top level of a directory
+    (for an MS: the main table and its columns) in bytes, 0 if it doesn't exist
+    """
+    if os.path.isdir(fname):
+        size = 0
+        for name in os.listdir(fname):
+            path = os.path.join(fname, name)
+            if os.path.isfile(path):
+                size += os.path.getsize(path)
+        return size
+    if os.path.isfile(fname):
+        return os.path.getsize(fname)
+    return 0
+
+########################################################################
+def assign_hosts(groups, hosts, file_hosts=None, host_mounts=None, tolerance=0.1):
+    """
+    Assign every group of files to one of the hosts
+
+    Parameters
+    ----------
+    groups : list of lists of str
+        Files of every group (without dummy files)
+    hosts : list of str
+        Hosts to distribute the groups over
+    file_hosts : dict, optional
+        Host of every file, e.g. from an input mapfile
+    host_mounts : dict or str, optional
+        Host -> mount map (see parse_host_mounts)
+    tolerance : float, optional
+        Fraction by which the input size of a host may exceed the balanced load
+
+    Returns
+    -------
+    group_hosts : list of str
+        Host of every group
+    """
+    if len(hosts) == 1 or len(groups) == 0:
+        return [hosts[0]] * len(groups)
+    host_mounts = parse_host_mounts(host_mounts)
+    # input bytes of every group, in total and per host that stores them
+    # (files that don't exist yet count as one byte, so that they are balanced by number)
+    sizes = []
+    local = []
+    for files in groups:
+        group_local = dict((host, 0) for host in hosts)
+        group_size = 0
+        for fname in files:
+            size = max(get_size(fname), 1)
+            host = get_file_host(fname, hosts, file_hosts, host_mounts)
+            if host is not None:
+                group_local[host] += size
+            group_size += size
+        sizes.append(group_size)
+        local.append(group_local)
+
+    max_load = (1. + tolerance) * sum(sizes) / len(hosts)
+    load = dict((host, 0) for host in hosts)
+    group_hosts = [None] * len(groups)
+    for groupIdx in sorted(range(len(groups)), key=lambda i: -sizes[i]):
+        candidates = [host for host in hosts if load[host] + sizes[groupIdx] <= max_load]
+        if not candidates:
+            min_load = min(load.values())
+            candidates = [host for host in hosts if load[host] == min_load]
+        host = max(candidates, key=lambda h: (local[groupIdx][h], -load[h]))
+        group_hosts[groupIdx] = host
+        load[host] += sizes[groupIdx]
+    return group_hosts
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Image sizes that are efficient for FFTs
+
+The optimum size for an image is the smallest even number that is at least
+the requested size and has no prime factors larger than 7. This is the same
+size that the prime-factor search taken from the CASA source code
+(cleanhelper.py) returns. All such numbers up to size_limit are precomputed
+once in a sorted table, so that a lookup is a bisection. The table is
+extended automatically for larger sizes, or can be set with set_size_limit().
+"""
+import bisect
+
+size_limit = 65536
+
+########################################################################
+def get_smooth_sizes(limit):
+    """
+    Return a sorted list of all even numbers up to limit with prime factors <= 7
+    """
+    sizes = []
+    p2 = 2
+    while p2 <= limit:
+        p3 = p2
+        while p3 <= limit:
+            p5 = p3
+            while p5 <= limit:
+                p7 = p5
+                while p7 <= limit:
+                    sizes.append(p7)
+                    p7 *= 7
+                p5 *= 5
+            p3 *= 3
+        p2 *= 2
+    return sorted(sizes)
+
+optimum_sizes = get_smooth_sizes(size_limit)
+
+########################################################################
+def set_size_limit(limit):
+    """
+    (Re)compute the table of optimum sizes up to limit
+    """
+    global size_limit, optimum_sizes
+    size_limit = int(limit)
+    optimum_sizes = get_smooth_sizes(size_limit)
+
+########################################################################
+def get_optimum_size(size):
+    """
+    Gets the nearest optimum image size
+
+    Parameters
+    ----------
+    size : int
+        Target image size in pixels
+
+    Returns
+    -------
+    optimum_size : int
+        Optimum image size nearest to target size
+
+    """
+    n = int(size)
+    if n < 0:
+        raise ValueError('get_optimum_size: the size must not be negative!')
+    if n == 0:
+        return 0
+    if n % 2 != 0:
+        n += 1
+    # there is always a power of two between n and 2n
+    while n > optimum_sizes[-1]:
+        set_size_limit(max(2 * size_limit, 2 * n))
+    return optimum_sizes[bisect.bisect_left(optimum_sizes, n)]
+
+########################################################################
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Print the optimum (FFT-friendly) image size for the given sizes.')
+    parser.add_argument('sizes', nargs='+', type=int, help='Target image sizes in pixels')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        print('%i: %i' % (size, get_optimum_size(size)))
@@ -0,0 +1,614 @@
+#!/usr/bin/env python
+"""
+Find islands of emission with NumPy/SciPy only
+
+This is a fast replacement for the part of PyBDSF that make_clean_mask needs:
+the clipped rms of the image, the background rms map, and the islands found with
+thresh_pix / thresh_isl (with mean_map='zero', rms_map=True, thresh='hard').
+The algorithms follow PyBDSF:
+  - clipped statistics: the PySE sigma-clipping of functions.bstat, with the
+    clipping level derived from the number of pixels per beam,
+  - rms map: clipped rms in boxes of rms_box = (size, step), the borders
+    either extrapolated or computed on a mirrored (padded) image, interpolated
+    with a spline of order spline_rank (1 if that gives negative values),
+  - islands: 8-connected pixels above thresh_isl * rms (scipy.ndimage.label),
+    with at least minpix_isl pixels and a peak above thresh_pix * rms.
+No Gaussians are fitted. The returned object mimics the attributes of a PyBDSF
+image that make_clean_mask uses (nisl, islands, clipped_rms, ch0_arr, rms_arr,
+export_image). Note that the arrays are in numpy order (y, x), whereas PyBDSF
+arrays are transposed (x, y).
+"""
+import casacore.images as pim
+import numpy as np
+import scipy.ndimage as nd
+from scipy.special import erf, erfcinv
+
+# number of pixels that are interpolated at once for the rms map
+interpolation_chunk = 4194304
+
+########################################################################
+def clipping_kappa(npix, kappa_npixbeam):
+    """
+    Return the clipping level for npix pixels (see PyBDSF's bstat)
+    """
+    if kappa_npixbeam > 0.0:
+        return np.zeros(np.shape(npix)) + kappa_npixbeam
+    npixbeam = abs(kappa_npixbeam)
+    kappa = np.sqrt(2.0) * erfcinv(1.0 / (2.0 * np.asarray(npix, dtype=float) / npixbeam))
+    return np.maximum(kappa, 3.0)
+
+########################################################################
+def clipped_mean_rms(mean, median, sigma, kappa):
+    """
+    Return the mode-or-median and the kappa-corrected rms of clipped samples
+    """
+    if np.any(sigma <= 0.0):
+        raise RuntimeError('A region with an unphysical rms value has been found. '
+                           'Please check the input image.')
+    skew_par = np.abs(mean - median) / sigma
+    m = np.where(skew_par <= 0.3, 2.5 * median - 1.5 * mean, median)
+    r1 = np.sqrt(2.0 * np.pi) * erf(kappa / np.sqrt(2.0))
+    r = np.sqrt(sigma**2 * (r1 / (r1 - 2.0 * kappa * np.exp(-kappa**2 / 2.0))))
+    return m, r
+
+########################################################################
+def bstat(data, kappa_npixbeam, maxiter=200, converge_num=1e-6):
+    """
+    Clipped mean and rms of the finite values of data (PyBDSF's bstat)
+
+    Returns
+    -------
+    m_raw, r_raw, m, r, niter : floats and int
+        Raw mean and rms, clipped mean and rms, number of iterations
+    """
+    skpix = np.sort(data[np.isfinite(data)].ravel())
+    ct = skpix.size
+    m_raw = np.mean(skpix)
+    d2 = (skpix - m_raw)**2
+    r_raw = (d2.sum() / (ct - 1))**0.5
+    niter = 0
+    c1 = 1.0
+    c2 = 0.0
+    while c1 >= c2 and niter < maxiter:
+        npix = skpix.size
+        kappa = clipping_kappa(npix, kappa_npixbeam)
+        lastct = ct
+        medval = skpix[npix // 2]
+        if niter == 0:
+            sig = r_raw
+        else:
+            sig = (d2.sum() / ct - (m_raw - np.mean(skpix))**2)**0.5
+        wsm1, wsm2 = np.searchsorted(skpix, [medval - kappa * sig, medval + kappa * sig])
+        ct = wsm2 - wsm1
+        if ct > 0:
+            skpix = skpix[wsm1:wsm2]
+            d2 = d2[wsm1:wsm2]
+        c1 = abs(ct - lastct)
+        c2 = converge_num * lastct
+        niter += 1
+
+    mean = np.mean(skpix)
+    sigma = (d2.sum() / (ct - 1) - (m_raw - mean)**2 * ct / (ct - 1))**0.5
+    m, r = clipped_mean_rms(mean, skpix[skpix.size // 2], sigma, kappa)
+    return m_raw, r_raw, float(m), float(r), niter
+
+########################################################################
+def box_stats(boxes, kappa_npixbeam, maxiter=200, converge_num=1e-6):
+    """
+    Clipped mean and rms of every row of boxes, ignoring NaNs
+
+    This is bstat for many boxes at once: every box is sorted once, and the
+    clipping window of every box is a range of its sorted values, so that the
+    sums over it are differences of cumulative sums and its edges are found
+    by a bisection of all boxes together. As in PyBDSF, the raw values are used
+    if the clipping does not converge. Boxes with 20 or fewer valid pixels get
+    inf.
+
+    Parameters
+    ----------
+    boxes : array
+        Array of shape (nboxes, npixels)
+    kappa_npixbeam : float
+        Clipping level, or minus the number of pixels per beam
+
+    Returns
+    -------
+    mean, rms : arrays
+        Clipped mean and rms of every box
+    """
+    nboxes = boxes.shape[0]
+    mean = np.empty(nboxes)
+    rms = np.empty(nboxes)
+    if nboxes == 0:
+        return mean, rms
+    x = np.sort(boxes.astype(np.float64), axis=1)   # NaNs are sorted to the end
+    valid = np.isfinite(x)
+    n = valid.sum(axis=1)
+
+    mean[n <= 20] = np.inf
+    rms[n <= 20] = np.inf
+    todo = np.nonzero(n > 20)[0]
+    if len(todo) == 0:
+        return mean, rms
+    x = x[todo]
+    valid = valid[todo]
+    n = n[todo]
+    rows = np.arange(len(todo))
+
+    xz = np.where(valid, x, 0.0)
+    m_raw = xz.sum(axis=1) / n
+    d2 = np.where(valid, (x - m_raw[:, np.newaxis])**2, 0.0)
+    r_raw = np.sqrt(d2.sum(axis=1) / (n - 1))
+    sum1 = np.zeros((len(todo), x.shape[1] + 1))
+    sum2 = np.zeros((len(todo), x.shape[1] + 1))
+    np.cumsum(xz, axis=1, out=sum1[:, 1:])
+    np.cumsum(d2, axis=1, out=sum2[:, 1:])
+    del xz, d2
+
+    def window_sums(sums, idx, lo, hi):
+        return sums[idx, hi] - sums[idx, lo]
+
+    def search(idx, lo, hi, value):
+        # first position in [lo, hi) of every box with a value >= value
+        a = lo.copy()
+        b = hi.copy()
+        searching = a < b
+        while np.any(searching):
+            mid = (a + b) // 2
+            below = x[idx, np.minimum(mid, x.shape[1] - 1)] < value
+            a = np.where(searching & below, mid + 1, a)
+            b = np.where(searching & ~below, mid, b)
+            searching = a < b
+        return a
+
+    lo = np.zeros(len(todo), dtype=int)
+    hi = n.copy()
+    ct = n.copy()
+    kappa = np.zeros(len(todo))
+    niter = np.zeros(len(todo), dtype=int)
+    active = rows.copy()
+    while len(active) > 0:
+        alo = lo[active]
+        ahi = hi[active]
+        npix = ahi - alo
+        kappa[active] = clipping_kappa(npix, kappa_npixbeam)
+        lastct = ct[active]
+        medval = x[active, alo + npix // 2]
+        if niter[active[0]] == 0:
+            sig = r_raw[active]
+        else:
+            m_new = window_sums(sum1, active, alo, ahi) / npix
+            sig = np.sqrt(window_sums(sum2, active, alo, ahi) / lastct - (m_raw[active] - m_new)**2)
+        wsm1 = search(active, alo, ahi, medval - kappa[active] * sig)
+        wsm2 = search(active, alo, ahi, medval + kappa[active] * sig)
+        newct = wsm2 - wsm1
+        update = newct > 0
+        lo[active[update]] = wsm1[update]
+        hi[active[update]] = wsm2[update]
+        ct[active] = newct
+        niter[active] += 1
+        converged = np.abs(newct - lastct) < converge_num * lastct
+        active = active[~converged & (niter[active] < maxiter)]
+
+    npix = hi - lo
+    cmean = window_sums(sum1, rows, lo, hi) / npix
+    sigma = np.sqrt(window_sums(sum2, rows, lo, hi) / (ct - 1) - (m_raw - cmean)**2 * ct / (ct - 1))
+    m, r = clipped_mean_rms(cmean, x[rows, lo + npix // 2], sigma, kappa)
+    # as PyBDSF, boxes that did not converge in time keep the raw mean and rms
+    failed = niter >= maxiter - 1
+    m[failed] = m_raw[failed]
+    r[failed] = r_raw[failed]
+    mean[todo] = m
+    rms[todo] = r
+    return mean, rms
+
+########################################################################
+def pad_array(arr, pad):
+    """
+    Return arr padded by pad pixels on all sides by mirroring around the edges
+    """
+    return np.pad(arr, pad, mode='symmetric')
+
+########################################################################
+def fill_masked_regions(themap, magic=np.inf):
+    """
+    Replace the magic values in themap by the mean of the nearest other values
+    """
+    masked_boxes = np.where(themap == magic)
+    for x, y in zip(masked_boxes[0], masked_boxes[1]):
+        delta = 1
+        while True:
+            cutout = themap[max(x - delta, 0):x + 1 + delta, max(y - delta, 0):y + 1 + delta].ravel()
+            goodcutout = cutout[cutout != magic]
+            if len(goodcutout) > 0:
+                themap[x, y] = np.nansum(goodcutout) / float(len(goodcutout))
+                break
+            delta += 1
+    themap[np.isnan(themap)] = 0.0
+    return themap
+
+########################################################################
+def rms_mean_map(arr, kappa_npixbeam, box):
+    """
+    Calculate the maps of the clipped mean and rms in boxes of the image
+
+    Parameters
+    ----------
+    arr : array
+        2D image, with NaNs for masked pixels
+    kappa_npixbeam : float
+        Clipping level, or minus the number of pixels per beam
+    box : tuple of ints
+        Size and step of the boxes in pixels
+
+    Returns
+    -------
+    axes : list of 2 arrays
+        Pixel coordinates of the boxes along each axis
+    mean_map, rms_map : arrays
+        Clipped mean and rms of the boxes
+    """
+    BS, SS = box
+    if BS < SS:
+        raise RuntimeError('Box size is less than step size.')
+    imgshape = np.array(arr.shape)
+
+    # If the box size is less than 10% of image, extrapolate the edges of the
+    # maps; otherwise, compute them on a mirrored (padded) version of arr
+    use_extrapolation = (float(BS) / float(imgshape[0]) < 0.1 and
+                         float(BS) / float(imgshape[1]) < 0.1)
+    if use_extrapolation:
+        boxcount = 1 + (imgshape - BS) / float(SS)
+        bounds = np.asarray((boxcount - 1) * SS + BS < imgshape, dtype=int)
+        mapshape = 2 + boxcount + bounds
+        offset = 1
+        data = arr
+    else:
+        boxcount = 1 + imgshape / float(SS)
+        bounds = np.asarray((boxcount - 1) * SS < imgshape, dtype=int)
+        mapshape = boxcount + bounds
+        offset = 0
+        data = pad_array(arr, int(BS / 2.0))
+    mapshape = [int(ms) for ms in mapshape]
+    boxcount = [int(bc) for bc in boxcount]
+    mean_map = np.zeros(mapshape, dtype=np.float32)
+    rms_map = np.zeros(mapshape, dtype=np.float32)
+
+    # Boxes along every axis as (start, end, map index): the regular boxes,
+    # plus one at the end of the axis if the regular ones don't reach it
+    ranges = []
+    for axis in range(2):
+        length = data.shape[axis]
+        axis_ranges = [(i * SS, min(i * SS + BS, length), i + offset) for i in range(boxcount[axis])]
+        if bounds[axis]:
+            axis_ranges.append((length - BS, length, -1 - offset))
+        ranges.append(axis_ranges)
+
+    # Process the boxes one row at a time
+    width = max(end - start for start, end, _ in ranges[1])
+    columns = np.array([start for start, _, _ in ranges[1]])[:, np.newaxis] + np.arange(width)
+    outside = columns >= np.array([end for _, end, _ in ranges[1]])[:, np.newaxis]
+    columns[outside] = 0
+    map_columns = [j for _, _, j in ranges[1]]
+    for start, end, i in ranges[0]:
+        boxes = data[start:end][:, columns]
+        boxes[:, outside] = np.nan
+        boxes = boxes.transpose(1, 0, 2)
+        mean_map[i, map_columns], rms_map[i, map_columns] = box_stats(
+            boxes.reshape(len(map_columns), -1), kappa_npixbeam)
+
+        # Boxes with 6-20 valid pixels get a plain mean and rms. PyBDSF
+        # (for_masked_mp) takes these of the pixels at the same positions
+        # in the box at the corner of the image, which is reproduced here
+        nvalid = np.sum(np.isfinite(boxes), axis=(1, 2))
+        for k in np.nonzero((nvalid > 5) & (nvalid <= 20))[0]:
+            values = data[np.nonzero(np.isfinite(boxes[k]))]
+            mean_map[i, map_columns[k]] = np.mean(values)
+            rms_map[i, map_columns[k]] = np.std(values)
+
+    if not np.any(mean_map != np.inf):
+        raise RuntimeError('No unmasked regions from which to determine mean and rms maps')
+
+    if use_extrapolation:
+        for themap in (mean_map, rms_map):
+            themap[0, :] = themap[1, :]
+            themap[:, 0] = themap[:, 1]
+            themap[-1, :] = themap[-2, :]
+            themap[:, -1] = themap[:, -2]
+            themap[0, 0] = (themap[1, 0] + themap[0, 1]) / 2.
+            themap[-1, 0] = (themap[-2, 0] + themap[-1, 1]) / 2.
+            themap[0, -1] = (themap[0, -2] + themap[1, -1]) / 2.
+            themap[-1, -1] = (themap[-2, -1] + themap[-1, -2]) / 2.
+
+    axes = [np.zeros(ms, dtype=np.float32) for ms in mapshape]
+    for i in range(2):
+        if use_extrapolation:
+            axes[i][1:boxcount[i]+1] = np.arange(boxcount[i]) * SS + BS / 2. - .5
+            if bounds[i]:
+                axes[i][-2] = imgshape[i] - BS / 2. - .5
+        else:
+            axes[i][0:boxcount[i]] = np.arange(boxcount[i]) * SS - .5
+            if bounds[i]:
+                axes[i][-2] = imgshape[i] - .5
+        axes[i][-1] = imgshape[i] - 1
+
+    if np.any(mean_map == np.inf):
+        mean_map = fill_masked_regions(mean_map)
+        rms_map = fill_masked_regions(rms_map)
+
+    return axes, mean_map, rms_map
+
+########################################################################
+def remap_axis(size, arr):
+    """
+    Return the coordinate in the box map of every pixel along an axis
+    """
+    res = np.zeros(size, dtype=np.float32)
+    for i in range(len(arr) - 1):
+        i1 = arr[i]
+        i2 = arr[i+1]
+        t = np.arange(np.ceil(i1), np.floor(i2) + 1, dtype=float)
+        res[int(np.ceil(i1)):int(np.floor(i2))+1] = i + (t - i1) / (i2 - i1)
+    return res
+
+########################################################################
+def interpolate_map(themap, axes, shape, order):
+    """
+    Interpolate a box map to the full image with a spline of the given order
+    """
+    coords = [remap_axis(size, ax) for size, ax in zip(shape, axes)]
+    if order > 1:
+        themap = nd.spline_filter(themap, order, output=np.float64, mode='constant')
+    out = np.empty(shape, dtype=np.float32)
+    nrows = max(1, interpolation_chunk // shape[1])
+    for start in range(0, shape[0], nrows):
+        ycoords = coords[0][start:start+nrows]
+        grid = np.array(np.broadcast_arrays(ycoords[:, np.newaxis], coords[1][np.newaxis, :]))
+        out[start:start+nrows] = nd.map_coordinates(themap, grid, order=order, prefilter=False)
+    return out
+
+########################################################################
+def make_rms_map(arr, kappa_npixbeam, box, spline_rank=3):
+    """
+    Return the background rms map of a 2D image (NaN for masked pixels)
+    """
+    masked = np.isnan(arr)
+    axes, mean_map, rms_map = rms_mean_map(arr, kappa_npixbeam, box)
+    rms = interpolate_map(rms_map, axes, arr.shape, spline_rank)
+    if np.any(rms[~masked] < 0.0):
+        if spline_rank <= 1:
+            raise RuntimeError('RMS map has negative values')
+        print('Negative values found in rms map interpolated with spline_rank = {0}; '
+              'using spline_rank = 1 instead'.format(spline_rank))
+        return make_rms_map(arr, kappa_npixbeam, box, spline_rank=1)
+    rms[masked] = np.nan
+    return rms
+
+########################################################################
+def angle_to_deg(quantity):
+    """
+    Convert a casacore quantity dict (value and unit) of an angle to degrees
+    """
+    factors = {'deg': 1.0, 'arcmin': 1.0/60.0, 'arcsec': 1.0/3600.0, 'rad': 180.0/np.pi}
+    return quantity['value'] * factors[quantity['unit']]
+
+########################################################################
+class Island:
+    """
+    Island of emission
+
+    Parameters
+    ----------
+    label : int
+        Label of the island in the label image
+    size_active : int
+        Number of pixels in the island
+    peak : float
+        Peak value of the island
+    max_posn : tuple of ints
+        Position (y, x) of the peak
+    """
+    def __init__(self, label, size_active, peak, max_posn):
+        self.label = label
+        self.size_active = size_active
+        self.peak = peak
+        self.max_posn = max_posn
+
+
+class IslandImage:
+    """
+    Image with the islands of emission found by process_image()
+
+    Parameters
+    ----------
+    beam : tuple of floats
+        Major axis, minor axis (deg) and position angle of the restoring beam
+    cdelt : list of floats
+        Absolute pixel size (deg) along the two image axes
+    """
+    def __init__(self, image_name, ch0_arr, beam, cdelt, pixel_beamarea, clipped_rms, rms_arr,
+                 island_labels, islands):
+        self.image_name = image_name
+        self.ch0_arr = ch0_arr
+        self.beam = beam
+        self.cdelt = cdelt
+        self.pixel_beamarea = pixel_beamarea
+        self.clipped_rms = clipped_rms
+        self.rms_arr = rms_arr
+        self.mean_arr = np.where(np.isnan(ch0_arr), np.nan, 0.0).astype(np.float32)
+        self.island_labels = island_labels
+        self.islands = islands
+        self.nisl = len(islands)
+
+    def island_mask(self, mask_dilation=0):
+        """
+        Return the boolean mask of the pixels in islands
+        """
+        keep = np.zeros(max(self.island_labels.max(), 0) + 1, dtype=bool)
+        keep[[isl.label for isl in self.islands]] = True
+        mask = keep[self.island_labels]
+        if mask_dilation > 0:
+            # As PyBDSF: dilate, then close holes smaller than the beam
+            mask = nd.binary_dilation(mask, iterations=mask_dilation)
+            pbeam = int(round(self.beam[0] / self.cdelt[0] * 1.5))
+            mask = nd.binary_closing(mask, structure=np.ones((pbeam, pbeam)))
+        return mask
+
+    def export_image(self, img_type='island_mask', mask_dilation=0, outfile=None,
+                     img_format='fits', clobber=False):
+        """
+        Write the island mask ('island_mask'), or the background 'rms' or 'mean'
+        map, as an image with the coordinates of the input image
+        """
+        if img_type == 'island_mask':
+            data = self.island_mask(mask_dilation)
+        elif img_type == 'rms':
+            data = self.rms_arr
+        elif img_type == 'mean':
+            data = self.mean_arr
+        else:
+            raise ValueError('export_image: img_type "{0}" not supported'.format(img_type))
+        if outfile is None:
+            outfile = self.image_name + '.' + img_type
+        input_img = pim.image(self.image_name)
+        shape = list(input_img.shape())
+        shape[:-2] = [1] * (len(shape) - 2)
+        out_data = np.zeros(shape, dtype=np.float32)
+        out_data[..., :, :] = data
+        output_img = pim.image('', shape=shape, coordsys=input_img.coordinates())
+        output_img.putdata(out_data)
+        if img_format == 'fits':
+            output_img.tofits(outfile, overwrite=clobber)
+        elif img_format == 'casa':
+            output_img.saveas(outfile, overwrite=clobber)
+        else:
+            raise ValueError('export_image: img_format "{0}" not understood'.format(img_format))
+        return True
+
+########################################################################
+def process_image(image_name, rms_box=None, thresh_pix=5.0, thresh_isl=3.0, mean_map='zero',
+                  rms_map=True, thresh='hard', atrous_do=False, adaptive_rms_box=False,
+                  rmsmean_map_filename=None, spline_rank=3, minpix_isl=None, **kwargs):
+    """
+    Find the islands of emission in an image
+
+    The parameters are those of PyBDSF's process_image(). Only the settings
+    make_clean_mask uses for plain island masks are supported (a given rms_box,
+    mean_map='zero', rms_map=True, thresh='hard', no wavelets, no adaptive rms
+    box); other PyBDSF parameters (e.g., ini_method, stop_at) are ignored.
+
+    Parameters
+    ----------
+    image_name : str
+        Filename of the input image (FITS or casacore)
+    rms_box : tuple of ints
+        Size and step of the boxes of the rms map in pixels
+    thresh_pix : float, optional
+        Minimum peak of an island in units of the rms
+    thresh_isl : float, optional
+        Threshold of the pixels in islands in units of the rms
+    rmsmean_map_filename : list of str, optional
+        Filenames of a mean and an rms map to use instead of computing them
+    spline_rank : int, optional
+        Order of the spline used to interpolate the rms map
+    minpix_isl : int, optional
+        Minimum number of pixels of an island (default: a third of the beam
+        area, at least 6)
+
+    Returns
+    -------
+    img : IslandImage
+        Image with the islands
+    """
+    if rms_box is None or mean_map != 'zero' or rms_map is not True or thresh != 'hard':
+        raise ValueError('process_image: only a given rms_box, mean_map="zero", rms_map=True and '
+                         'thresh="hard" are supported')
+    if atrous_do or adaptive_rms_box:
+        raise ValueError('process_image: wavelets and adaptive rms boxes are not supported')
+    rms_box = tuple(int(b) for b in rms_box)
+
+    input_img = pim.image(image_name)
+    ch0_arr = input_img.getdata()[0, 0].astype(np.float32)
+    beaminfo = input_img.imageinfo().get('restoringbeam', {})
+    if 'major' not in beaminfo:
+        raise RuntimeError('No beam information found in image header.')
+    beam = (angle_to_deg(beaminfo['major']), angle_to_deg(beaminfo['minor']),
+            angle_to_deg(beaminfo['positionangle']))
+    direction = input_img.coordinates()['direction']
+    cdelt = [abs(angle_to_deg({'value': value, 'unit': unit}))
+             for value, unit in zip(direction.get_increment(), direction.get_unit())][::-1]
+    pixel_beamarea = 1.1331 * beam[0] / cdelt[0] * beam[1] / cdelt[1]
+    kappa_npixbeam = -pixel_beamarea
+
+    clipped_rms = bstat(ch0_arr, kappa_npixbeam)[3]
+    if clipped_rms == 0.0:
+        raise RuntimeError('Clipped rms appears to be zero. Check for regions with values '
+                           'of 0 and blank them (with NaNs).')
+    masked = np.isnan(ch0_arr)
+    if rms_box[0] > min(ch0_arr.shape) / 4.0:
+        # rms box is too large - just use a constant rms
+        rms_arr = np.zeros(ch0_arr.shape, dtype=np.float32) + np.float32(clipped_rms)
+        rms_arr[masked] = np.nan
+    elif rmsmean_map_filename:
+        rms_arr = pim.image(rmsmean_map_filename[1]).getdata()[0, 0].astype(np.float32)
+    else:
+        rms_arr = make_rms_map(ch0_arr, kappa_npixbeam, rms_box, spline_rank)
+
+    # Active pixels are at least thresh_isl times the rms (NaNs compare False)
+    with np.errstate(invalid='ignore'):
+        act_pixels = ch0_arr / np.float32(thresh_isl) >= rms_arr
+    island_labels, count = nd.label(act_pixels, nd.generate_binary_structure(2, 2))
+    islands = []
+    if count > 0:
+        if minpix_isl is None:
+            minpix_isl = max(int(pixel_beamarea / 3.0), 6)
+        sizes = np.bincount(island_labels.ravel(), minlength=count + 1)
+        slices = nd.find_objects(island_labels)
+        for label in np.nonzero(sizes >= minpix_isl)[0]:
+            if label == 0:
+                continue
+            s = slices[label - 1]
+            sub_image = np.where(island_labels[s] == label, ch0_arr[s], -np.inf)
+            max_posn = np.unravel_index(np.argmax(sub_image), sub_image.shape)
+            posn = (max_posn[0] + s[0].start, max_posn[1] + s[1].start)
+            peak = ch0_arr[posn]
+            if peak / thresh_pix > rms_arr[posn]:
+                islands.append(Island(label, sizes[label], peak, posn))
+
+    return IslandImage(image_name, ch0_arr, beam, cdelt, pixel_beamarea, clipped_rms, rms_arr,
+                       island_labels, islands)
+
+########################################################################
+def compare_images(img, pybdsf_img):
+    """
+    Compare the results of process_image() with those of PyBDSF
+
+    Parameters
+    ----------
+    img : IslandImage
+        Result of process_image()
+    pybdsf_img : PyBDSF Image
+        Result of PyBDSF's process_image() for the same image and parameters
+
+    Returns
+    -------
+    result : dict
+        Number of islands, clipped rms, largest relative difference of the rms
+        maps and number of pixels of which the island masks differ
+    """
+    mask = img.island_mask()
+    pybdsf_mask = (pybdsf_img.pyrank + 1 > 0).T
+    pybdsf_rms = pybdsf_img.rms_arr.T
+    valid = np.isfinite(img.rms_arr) & np.isfinite(pybdsf_rms)
+    rms_diff = np.abs(img.rms_arr[valid] / pybdsf_rms[valid] - 1.0)
+    result = {'nisl': (img.nisl, pybdsf_img.nisl),
+              'clipped_rms': (img.clipped_rms, pybdsf_img.clipped_rms),
+              'max_rms_map_diff': float(rms_diff.max()) if rms_diff.size > 0 else 0.0,
+              'mask_pixels': (int(mask.sum()), int(pybdsf_mask.sum())),
+              'mask_pixels_differing': int(np.sum(mask != pybdsf_mask))}
+    print('Islands (native / PyBDSF): {0} / {1}'.format(*result['nisl']))
+    print('Clipped rms (native / PyBDSF): {0} / {1}'.format(*result['clipped_rms']))
+    print('Largest relative difference of the rms maps: {0}'.format(result['max_rms_map_diff']))
+    print('Island mask pixels (native / PyBDSF): {0} / {1}, differing: {2}'.format(
+          result['mask_pixels'][0], result['mask_pixels'][1], result['mask_pixels_differing']))
+    return result
@@ -7,10 +7,12 @@ from argparse import RawTextHelpFormatter
 import casacore.images as pim
 from astropy.io import fits as pyfits
 from astropy.coordinates import Angle
+from astropy.wcs import WCS
 import pickle
 import numpy as np
 import sys
 import os
+import shutil
 
 # I copy&pasted that into this file
 #from factor.lib.polygon import Polygon
@@ -26,7 +28,13 @@ except (RuntimeError, ImportError):
 try:
     import bdsf
 except ImportError:
-    from lofar import bdsm as bdsf
+    try:
+        from lofar import bdsm as bdsf
+    except ImportError:
+        # only the native island finder can be used
+        bdsf = None
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import island_finder
 
 class Polygon:
     """
@@ -189,6 +197,125 @@ class Polygon:
         return mindst
 
 
+    def rasterize(self, shape, include_boundary=False, smalld=1e-12):
+        """
+        Fill the polygon into a boolean mask of pixel centres.
+
+        Uses an even-odd scanline fill restricted to the bounding box of the
+        polygon: for every integer x, the pixels between pairs of crossings of
+        the polygon sides are set. A pixel (i, j) corresponds to the point
+        (xpoint, ypoint) = (i, j) of is_inside, and gets the same inside/outside
+        decision.
+
+        Parameters
+        ----------
+        shape : tuple of ints
+            Shape (nx, ny) of the mask
+        include_boundary : bool, optional
+            If True, pixels on a side of the polygon (is_inside() = 0) are
+            inside, otherwise they are outside
+        smalld : float
+            Tolerance within which a point is considered to be on a side.
+
+        Returns
+        -------
+        mask : array of bool
+            True for the pixels inside the polygon
+
+        """
+        mask = np.zeros(shape, dtype=bool)
+        x = self.x
+        y = self.y
+        xmin = max(int(np.ceil(np.min(x) - smalld)), 0)
+        xmax = min(int(np.floor(np.max(x) + smalld)), shape[0] - 1)
+        ymin = max(int(np.ceil(np.min(y) - smalld)), 0)
+        ymax = min(int(np.floor(np.max(y) + smalld)), shape[1] - 1)
+        if xmin > xmax or ymin > ymax:
+            return mask
+
+        # Crossings of every scanline with the sides. A side crosses the
+        # scanline x = i if min(x1, x2) <= i < max(x1, x2), so that a vertex
+        # is counted once where the polygon passes it and twice (or not at
+        # all) where it turns
+        rows = np.arange(xmin, xmax + 1, dtype=float)[:, np.newaxis]
+        x1 = x[:-1]
+        y1 = y[:-1]
+        x2 = x[1:]
+        y2 = y[1:]
+        crosses = (np.minimum(x1, x2) <= rows) & (rows < np.maximum(x1, x2))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ycross = np.where(crosses, y1 + (rows - x1) * (y2 - y1) / (x2 - x1), np.inf)
+        ycross.sort(axis=1)
+        starts = ycross[:, 0::2]
+        stops = ycross[:, 1::2]
+        if starts.shape[1] > stops.shape[1]:
+            starts = starts[:, :stops.shape[1]]
+        row_ind = np.repeat(np.arange(len(rows)), stops.shape[1]).reshape(stops.shape)
+        valid = np.isfinite(stops)
+        starts = starts[valid]
+        stops = stops[valid]
+        row_ind = row_ind[valid]
+
+        # Fill the spans between pairs of crossings (one slice per span, so no
+        # temporary arrays of the size of the mask are needed)
+        if include_boundary:
+            first = np.ceil(starts - smalld)
+            last = np.floor(stops + smalld)
+        else:
+            first = np.floor(starts + smalld) + 1
+            last = np.ceil(stops - smalld) - 1
+        first = np.maximum(first, ymin).astype(int)
+        last = np.minimum(last, ymax).astype(int)
+        valid = first <= last
+        for i, jfirst, jlast in zip(row_ind[valid] + xmin, first[valid], last[valid]):
+            mask[i, jfirst:jlast+1] = True
+
+        # Points on sides along a scanline and on vertices are not handled
+        # consistently by the crossings, set them explicitly
+        xint = np.round(x)
+        yint = np.round(y)
+        for i in np.where((np.fabs(x2 - x1) < smalld) & (np.fabs(x1 - xint[:-1]) < smalld))[0]:
+            if xmin <= xint[i] <= xmax:
+                jmin = max(int(np.ceil(min(y1[i], y2[i]) - smalld)), ymin)
+                jmax = min(int(np.floor(max(y1[i], y2[i]) + smalld)), ymax)
+                mask[int(xint[i]), jmin:jmax+1] = include_boundary
+        on_vertex = ((np.fabs(x - xint) < smalld) & (np.fabs(y - yint) < smalld) &
+                     (xint >= xmin) & (xint <= xmax) & (yint >= ymin) & (yint <= ymax))
+        mask[xint[on_vertex].astype(int), yint[on_vertex].astype(int)] = include_boundary
+
+        return mask
+
+
+def _det(xvert, yvert):
+    """
+    Compute twice the area of the triangle defined by points with using
+    determinant formula.
+
+    Parameters
+    ----------
+    xvert : array
+        A vector of nodal x-coords.
+    yvert : array
+        A vector of nodal y-coords.
+
+    Returns
+    -------
+    area : float
+        Twice the area of the triangle defined by the points:
+
+        area is positive if points define polygon in anticlockwise order.
+        area is negative if points define polygon in clockwise order.
+        area is zero if at least two of the points are concident or if
+        all points are collinear.
+
+    """
+    xvert = np.asfarray(xvert)
+    yvert = np.asfarray(yvert)
+    x_prev = np.concatenate(([xvert[-1]], xvert[:-1]))
+    y_prev = np.concatenate(([yvert[-1]], yvert[:-1]))
+    return np.sum(yvert * x_prev - xvert * y_prev, axis=0)
+
+
 
 def read_vertices(filename):
     """
@@ -199,42 +326,104 @@ def read_vertices(filename):
     return direction_dict['vertices']
 
 
-def read_casa_polys(filename, image):
+def get_direction_wcs(image):
+    """
+    Returns an astropy WCS of the direction axes of a casacore image
     """
-    Reads casa region file and returns polys
+    direction = image.coordinates()['direction']
+    record = direction.dict()
+    units = direction.get_unit()
+    dec, ra = [island_finder.angle_to_deg({'value': value, 'unit': unit})
+               for value, unit in zip(direction.get_referencevalue(), units)]
+    ddec, dra = [island_finder.angle_to_deg({'value': value, 'unit': unit})
+                 for value, unit in zip(direction.get_increment(), units)]
+    ypix, xpix = direction.get_referencepixel()
+    projection = direction.get_projection()
+
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---' + projection, 'DEC--' + projection]
+    wcs.wcs.crval = [ra, dec]
+    wcs.wcs.crpix = [xpix + 1, ypix + 1]
+    wcs.wcs.cdelt = [dra, ddec]
+    wcs.wcs.pc = record['pc']
+    wcs.wcs.lonpole = record['longpole']
+    wcs.wcs.latpole = record['latpole']
+    # the parameters of the projections start at PV2_1 (e.g., xi and eta of SIN)
+    wcs.wcs.set_pv([(2, i + 1, value) for i, value in enumerate(record['projection_parameters'])])
+    return wcs
+
+
+def radec_to_pixel(wcs, ra_deg, dec_deg):
+    """
+    Converts RA and Dec (in degrees) to pixel coordinates with an astropy WCS
+    of the direction axes of an image (see get_direction_wcs)
 
-    Note: only regions of type "poly" are supported
+    All positions are converted in one vectorised call. Returns the pixel
+    coordinates along the Dec axis (x) and the RA axis (y)
+    """
+    ra_deg = np.atleast_1d(np.asarray(ra_deg, dtype=float))
+    dec_deg = np.atleast_1d(np.asarray(dec_deg, dtype=float))
+    if len(ra_deg) == 0:
+        return np.zeros(0), np.zeros(0)
+    ypix, xpix = wcs.wcs_world2pix(ra_deg, dec_deg, 0)
+    return xpix, ypix # x -> Dec, y -> RA
+
+
+def parse_angles(angle_strs, unit):
+    """
+    Converts angle strings to degrees
+
+    Strings of the form [+-]d:m:s (in hours if unit is 'hourangle') are parsed
+    all at once. Other forms are parsed by astropy's Angle
+    """
+    if len(angle_strs) == 0:
+        return np.zeros(0)
+    angle_strs = [angle_str.strip() for angle_str in angle_strs]
+    try:
+        dms = np.array([[float(f) for f in angle_str.split(':')] for angle_str in angle_strs])
+    except ValueError:
+        dms = None
+    if dms is None or dms.ndim != 2 or dms.shape[1] != 3:
+        return Angle(angle_strs, unit=unit).to('deg').value
+    sign = np.array([-1.0 if angle_str.startswith('-') else 1.0 for angle_str in angle_strs])
+    angles = sign * (np.abs(dms[:, 0]) + dms[:, 1] / 60.0 + dms[:, 2] / 3600.0)
+    if unit == 'hourangle':
+        angles *= 15.0
+    return angles
+
+
+def read_casa_polys(filename, wcs):
+    """
+    Reads casa region file and returns polys in the pixel coordinates given
+    by wcs (an astropy WCS of the direction axes of the image)
+
+    Note: only regions of type "poly", "box", and "ellipse" are supported.
+    The positions of all regions are converted to degrees and to image pixels
+    at once
     """
     with open(filename, 'r') as f:
         lines = f.readlines()
 
-    polys = []
+    # Collect the positions of all regions as strings, with for every region
+    # the index of its first position, the number of positions and, for
+    # ellipses, the axes and position angle
+    RAstrs = []
+    Decstrs = []
+    regions = []
     for line in lines:
-        if line.startswith('poly'):
+        if line.startswith('poly') or line.startswith('box'):
             poly_str_temp = line.split('[[')[1]
             poly_str = poly_str_temp.split(']]')[0]
             poly_str_list = poly_str.split('], [')
-            ra = []
-            dec = []
-            for pos in poly_str_list:
-                RAstr, Decstr = pos.split(',')
-                ra.append(Angle(RAstr, unit='hourangle').to('deg').value)
-                dec.append(Angle(Decstr.replace('.', ':', 2), unit='deg').to('deg').value)
-            poly_vertices = [np.array(ra), np.array(dec)]
-
-            # Convert to image-plane polygon
-            xvert = []
-            yvert = []
-            for RAvert, Decvert in zip(np.array(ra), np.array(dec)):
-                try:
-                    pixels = image.topixel([0, 1, Decvert*np.pi/180.0,
-                                               RAvert*np.pi/180.0])
-                except:
-                    pixels = image.topixel([1, 1, Decvert*np.pi/180.0,
-                                               RAvert*np.pi/180.0])
-                xvert.append(pixels[2]) # x -> Dec
-                yvert.append(pixels[3]) # y -> RA
-            polys.append(Polygon(xvert, yvert))
+            positions = [pos.split(',') for pos in poly_str_list]
+            if line.startswith('box'):
+                # Corners of the box from two opposite ones
+                (RA1, Dec1), (RA2, Dec2) = positions[0], positions[1]
+                positions = [(RA1, Dec1), (RA1, Dec2), (RA2, Dec2), (RA2, Dec1)]
+            regions.append((len(RAstrs), len(positions), None))
+            for RAstr, Decstr in positions:
+                RAstrs.append(RAstr)
+                Decstrs.append(Decstr)
 
         elif line.startswith('ellipse'):
             ell_str_temp = line.split('[[')[1]
@@ -250,70 +439,14 @@ def read_casa_polys(filename, image):
                 pa = 90
             ell_str_list = ell_str.split('], [')
 
-            # Ellipse center
+            # Ellipse center, semimajor and semiminor axes
             RAstr, Decstr = ell_str_list[0].split(',')
-            ra_center = Angle(RAstr, unit='hourangle').to('deg').value
-            dec_center = Angle(Decstr.replace('.', ':', 2), unit='deg').to('deg').value
-            pixels = image.topixel([0, 1, dec_center*np.pi/180.0,
-                ra_center*np.pi/180.0])
-            x_center = pixels[2] # x -> Dec
-            y_center = pixels[3] # y -> RA
-
-            # Ellipse semimajor and semiminor axes
             a_str, b_str = ell_str_list[1].split(',')
             a_deg = float(a_str.split('arcsec')[0])/3600.0
             b_deg = float(b_str.split('arcsec')[0])/3600.0
-            pixels1 = image.topixel([0, 1, (dec_center-a_deg/2.0)*np.pi/180.0,
-                ra_center*np.pi/180.0])
-            a_pix1 = pixels1[2]
-            pixels2 = image.topixel([0, 1, (dec_center+a_deg/2.0)*np.pi/180.0,
-                ra_center*np.pi/180.0])
-            a_pix2 = pixels2[2]
-            a_pix = abs(a_pix2 - a_pix1)
-            ex = []
-            ey = []
-            for th in range(0, 360, 1):
-                if pa == 0:
-                    # semimajor axis is along x-axis
-                    ex.append(a_pix * np.cos(th * np.pi / 180.0)
-                        + x_center) # x -> Dec
-                    ey.append(a_pix * b_deg / a_deg * np.sin(th * np.pi / 180.0) + y_center) # y -> RA
-                elif pa == 90:
-                    # semimajor axis is along y-axis
-                    ex.append(a_pix * b_deg / a_deg * np.cos(th * np.pi / 180.0)
-                        + x_center) # x -> Dec
-                    ey.append(a_pix * np.sin(th * np.pi / 180.0) + y_center) # y -> RA
-            polys.append(Polygon(ex, ey))
-
-        elif line.startswith('box'):
-            poly_str_temp = line.split('[[')[1]
-            poly_str = poly_str_temp.split(']]')[0]
-            poly_str_list = poly_str.split('], [')
-            ra = []
-            dec = []
-            for pos in poly_str_list:
-                RAstr, Decstr = pos.split(',')
-                ra.append(Angle(RAstr, unit='hourangle').to('deg').value)
-                dec.append(Angle(Decstr.replace('.', ':', 2), unit='deg').to('deg').value)
-            ra.insert(1, ra[0])
-            dec.insert(1, dec[1])
-            ra.append(ra[2])
-            dec.append(dec[0])
-            poly_vertices = [np.array(ra), np.array(dec)]
-
-            # Convert to image-plane polygon
-            xvert = []
-            yvert = []
-            for RAvert, Decvert in zip(np.array(ra), np.array(dec)):
-                try:
-                    pixels = image.topixel([0, 1, Decvert*np.pi/180.0,
-                                               RAvert*np.pi/180.0])
-                except:
-                    pixels = image.topixel([1, 1, Decvert*np.pi/180.0,
-                                               RAvert*np.pi/180.0])
-                xvert.append(pixels[2]) # x -> Dec
-                yvert.append(pixels[3]) # y -> RA
-            polys.append(Polygon(xvert, yvert))
+            regions.append((len(RAstrs), 1, (a_deg, b_deg, pa)))
+            RAstrs.append(RAstr)
+            Decstrs.append(Decstr)
 
         elif line.startswith('#'):
             pass
@@ -322,9 +455,155 @@ def read_casa_polys(filename, image):
             print('Only CASA regions of type "poly", "box", or "ellipse" are supported')
             sys.exit(1)
 
+    ra = parse_angles(RAstrs, 'hourangle')
+    dec = parse_angles([Decstr.replace('.', ':', 2) for Decstr in Decstrs], 'deg')
+
+    # Convert to image-plane positions, together with the ends of the major
+    # axes of the ellipses (along Dec), which give their sizes in pixels
+    ellipses = [(first, ellipse) for first, npos, ellipse in regions if ellipse is not None]
+    centers = np.array([first for first, ellipse in ellipses], dtype=int)
+    a_deg = np.array([ellipse[0] for first, ellipse in ellipses])
+    xpix, ypix = radec_to_pixel(wcs, np.concatenate((ra, ra[centers], ra[centers])),
+                                np.concatenate((dec, dec[centers] - a_deg/2.0, dec[centers] + a_deg/2.0)))
+    a_pix = np.abs(xpix[len(ra)+len(centers):] - xpix[len(ra):len(ra)+len(centers)])
+
+    polys = []
+    th = np.arange(0, 360, 1) * np.pi / 180.0
+    ellipse_index = 0
+    for first, npos, ellipse in regions:
+        if ellipse is None:
+            polys.append(Polygon(xpix[first:first+npos], ypix[first:first+npos]))
+        else:
+            a_deg, b_deg, pa = ellipse
+            axis_pix = a_pix[ellipse_index]
+            ellipse_index += 1
+            if pa == 0:
+                # semimajor axis is along x-axis
+                ex = axis_pix * np.cos(th) + xpix[first] # x -> Dec
+                ey = axis_pix * b_deg / a_deg * np.sin(th) + ypix[first] # y -> RA
+            else:
+                # semimajor axis is along y-axis
+                ex = axis_pix * b_deg / a_deg * np.cos(th) + xpix[first] # x -> Dec
+                ey = axis_pix * np.sin(th) + ypix[first] # y -> RA
+            polys.append(Polygon(ex, ey))
+
     return polys
 
 
+def is_float_fits(filename):
+    """
+    Returns True if filename is a FITS file with unscaled floating-point data,
+    which can be edited in place through a memory map
+    """
+    if not os.path.isfile(filename):
+        return False
+    try:
+        header = pyfits.getheader(filename)
+    except (IOError, OSError):
+        return False
+    return (header.get('BITPIX', 0) < 0 and header.get('BSCALE', 1.0) == 1.0
+            and header.get('BZERO', 0.0) == 0.0)
+
+
+def open_fits_image(filename):
+    """
+    Opens a FITS image for editing in place and returns the HDU list and the
+    memory-mapped data as a (nfreq, nstokes, ny, nx) array
+    """
+    hdulist = pyfits.open(filename, mode='update', memmap=True)
+    data = hdulist[0].data
+    if data.ndim == 2:
+        data = data[np.newaxis, np.newaxis]
+    return hdulist, data
+
+
+def make_fits_mask(input_name, mask_name, pad_to_size=None, reference_ra_deg=None,
+    reference_dec_deg=None, copy_data=True):
+    """
+    Makes the FITS mask image mask_name from the FITS image input_name
+
+    The mask is written to disk once and edited through a memory map, so that
+    no copy of it is held in memory. If input_name is mask_name and no padding
+    is done, the mask is edited in place. Note that this covers only the mask:
+    the blanked input image that main() gives to PyBDSF (see vertices_file) is
+    still a full copy of the image on disk
+
+    Parameters
+    ----------
+    input_name : str
+        Filename of input FITS image
+    mask_name : str
+        Filename of output FITS mask
+    pad_to_size : int, optional
+        Pad output mask image to a size of pad_to_size x pad_to_size
+    reference_ra_deg : float, optional
+        RA for center of output mask image
+    reference_dec_deg : float, optional
+        Dec for center of output mask image
+    copy_data : bool, optional
+        If True, copy the data of the input image to the mask (otherwise the
+        mask is initialized with zeros)
+
+    Returns
+    -------
+    hdulist, data : HDU list and array
+        Opened mask and its memory-mapped data (see open_fits_image)
+    """
+    if pad_to_size is None and input_name == mask_name:
+        hdulist, data = open_fits_image(mask_name)
+        if reference_ra_deg is not None and reference_dec_deg is not None:
+            hdulist[0].header['CRVAL1'] = reference_ra_deg
+            hdulist[0].header['CRVAL2'] = reference_dec_deg
+        return hdulist, data
+
+    input_hdulist = pyfits.open(input_name, memmap=True)
+    header = input_hdulist[0].header.copy()
+    input_data = input_hdulist[0].data
+    if reference_ra_deg is not None and reference_dec_deg is not None:
+        header['CRVAL1'] = reference_ra_deg
+        header['CRVAL2'] = reference_dec_deg
+    shape = list(input_data.shape)
+    if pad_to_size is not None:
+        imsize = pad_to_size
+        pixmin = (imsize - shape[-2]) // 2
+        if pixmin < 0:
+            print("The padded size must be larger than the original size.")
+            sys.exit(1)
+        pixmax = pixmin + shape[-2]
+        shape = [1] * (len(shape) - 2) + [imsize, imsize]
+        for axis in range(3, len(shape) + 1):
+            header['NAXIS{}'.format(axis)] = 1
+        header['NAXIS1'] = imsize
+        header['NAXIS2'] = imsize
+        header['CRPIX1'] = imsize // 2 + 1
+        header['CRPIX2'] = imsize // 2 + 1
+    else:
+        pixmin = 0
+        pixmax = shape[-2]
+
+    # Write the header and extend the file to the size of the data, which
+    # then reads as zeros
+    header['BITPIX'] = -32
+    for keyword in ['BSCALE', 'BZERO', 'BLANK']:
+        header.remove(keyword, ignore_missing=True)
+    temp_name = mask_name + '.tmp'
+    header.tofile(temp_name, overwrite=True)
+    datasize = int(np.prod(shape)) * 4
+    datasize = ((datasize + 2879) // 2880) * 2880
+    with open(temp_name, 'rb+') as f:
+        f.seek(os.path.getsize(temp_name) + datasize - 1)
+        f.write(b'\0')
+
+    if copy_data:
+        output_hdulist, output_data = open_fits_image(temp_name)
+        output_data[0, 0, pixmin:pixmax, pixmin:pixmax] = input_data.reshape(
+            (1, 1) + input_data.shape[-2:])[0, 0]
+        output_hdulist.close()
+    input_hdulist.close()
+    os.rename(temp_name, mask_name)
+    return open_fits_image(mask_name)
+
+
 def make_template_image(image_name, reference_ra_deg, reference_dec_deg,
     imsize=512, cellsize_deg=0.000417):
     """
@@ -390,12 +669,27 @@ def make_template_image(image_name, reference_ra_deg, reference_dec_deg,
 
 
 
+def find_islands(engine, image_name, **kwargs):
+    """
+    Run the source finder given by engine ('pybdsf', 'native' or 'validate')
+    with the PyBDSF process_image() parameters kwargs
+    """
+    if engine == 'native':
+        return island_finder.process_image(image_name, **kwargs)
+    img = bdsf.process_image(image_name, **kwargs)
+    if engine == 'validate':
+        print('Comparing the native island finder with PyBDSF...')
+        island_finder.compare_images(island_finder.process_image(image_name, **kwargs), img)
+    return img
+
+
 def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, rmsbox=None,
          rmsbox_bright=(35, 7), iterate_threshold=False, adaptive_rmsbox=False, img_format='fits',
          threshold_format='float', trim_by=0.0, vertices_file=None, atrous_jmax=6,
          pad_to_size=None, skip_source_detection=False, region_file=None, nsig=1.0,
          reference_ra_deg=None, reference_dec_deg=None, cellsize_deg=0.000417,
-         use_adaptive_threshold=False, adaptive_thresh=150.0):
+         use_adaptive_threshold=False, adaptive_thresh=150.0, reuse_rms_maps=False,
+         engine='pybdsf'):
     """
     Make a clean mask and return clean threshold
 
@@ -431,7 +725,9 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
         trimmed (zeroed)
     vertices_file : str, optional
         Filename of file with vertices (must be a pickle file containing
-        a dictionary with the vertices in the 'vertices' entry)
+        a dictionary with the vertices in the 'vertices' entry). Source
+        detection is then done on a full copy of the image (image_name +
+        '.blanked') in which the pixels outside of the polygon are blanked
     atrous_jmax : int, optional
         Value of atrous_jmax PyBDSF parameter
     pad_to_size : int, optional
@@ -455,6 +751,15 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
     adaptive_thresh : float, optional
         If adaptive_rmsbox is True, this value sets the threshold above
         which a source will use the small rms box
+    reuse_rms_maps : bool, optional
+        If True and PyBDSF is run more than once (use_adaptive_threshold or
+        iterate_threshold), compute the background mean and rms maps only in
+        the first run and reuse them in the others
+    engine : str, optional
+        Source finder used to make the island mask: 'pybdsf', 'native' (the
+        NumPy/SciPy island finder of island_finder.py, which fits no Gaussians
+        and supports neither wavelets nor adaptive rms boxes), or 'validate'
+        (PyBDSF, with the results of every run compared to the native finder)
 
     Returns
     -------
@@ -502,6 +807,23 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
         else:
             use_adaptive_threshold = False
 
+    if type(reuse_rms_maps) is str:
+        if reuse_rms_maps.lower() == 'true':
+            reuse_rms_maps = True
+        else:
+            reuse_rms_maps = False
+
+    if engine != 'pybdsf' and (atrous_do or adaptive_rmsbox or rmsbox is None):
+        print('The native island finder needs an rms box and supports neither wavelets nor '
+              'adaptive rms boxes. Using PyBDSF instead.')
+        engine = 'pybdsf'
+    if engine not in ['pybdsf', 'native', 'validate']:
+        print('Source finder engine "{}" not understood.'.format(engine))
+        sys.exit(1)
+    if engine != 'native' and bdsf is None and not skip_source_detection:
+        print('ERROR: PyBDSF could not be imported. Use the native source finder engine.')
+        sys.exit(1)
+
     if reference_ra_deg is not None and reference_dec_deg is not None:
         reference_ra_deg = float(reference_ra_deg)
         reference_dec_deg = float(reference_dec_deg)
@@ -529,86 +851,116 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
 
     if not skip_source_detection:
         if vertices_file is not None:
-            # Modify the input image to blank the regions outside of the polygon
-            temp_img = pim.image(image_name)
-            image_name += '.blanked'
-            temp_img.saveas(image_name, overwrite=True)
-            input_img = pim.image(image_name)
-            data = input_img.getdata()
+            # Modify a copy of the input image to blank the regions outside of
+            # the polygon (an old copy may be a FITS file or a casacore image)
+            if os.path.isdir(image_name + '.blanked'):
+                shutil.rmtree(image_name + '.blanked')
+            elif os.path.exists(image_name + '.blanked'):
+                os.remove(image_name + '.blanked')
+            if is_float_fits(image_name):
+                # Copy the file and edit it through a memory map. PyBDSF reads
+                # the image from disk, so the full copy of the file cannot be
+                # avoided, but no copy of the image is held in memory
+                shutil.copyfile(image_name, image_name + '.blanked')
+                image_name += '.blanked'
+                hdulist, data = open_fits_image(image_name)
+                wcs = WCS(hdulist[0].header).celestial
+            else:
+                temp_img = pim.image(image_name)
+                image_name += '.blanked'
+                temp_img.saveas(image_name, overwrite=True)
+                input_img = pim.image(image_name)
+                data = input_img.getdata()
+                wcs = get_direction_wcs(input_img)
+                hdulist = None
 
             vertices = read_vertices(vertices_file)
-            RAverts = vertices[0]
-            Decverts = vertices[1]
-            xvert = []
-            yvert = []
-            for RAvert, Decvert in zip(RAverts, Decverts):
-                pixels = input_img.topixel([1, 1, Decvert*np.pi/180.0,
-                    RAvert*np.pi/180.0])
-                xvert.append(pixels[2]) # x -> Dec
-                yvert.append(pixels[3]) # y -> RA
+            xvert, yvert = radec_to_pixel(wcs, vertices[0], vertices[1])
             poly = Polygon(xvert, yvert)
 
-            # Find masked regions
-            masked_ind = np.where(data[0, 0])
-
-            # Find distance to nearest poly edge and set to NaN those that
-            # are outside the facet (dist < 0)
-            dist = poly.is_inside(masked_ind[0], masked_ind[1])
-            outside_ind = np.where(dist < 0.0)
-            if len(outside_ind[0]) > 0:
-                data[0, 0, masked_ind[0][outside_ind], masked_ind[1][outside_ind]] = np.nan
+            # Set to NaN the (non-zero) pixels that are outside the facet
+            # (pixels on the facet edge are kept)
+            outside = ~poly.rasterize(data.shape[2:], include_boundary=True)
+            data[0, 0][outside & (data[0, 0] != 0)] = np.nan
 
             # Save changes
-            input_img.putdata(data)
-
-        if use_adaptive_threshold:
-            # Get an estimate of the rms
-            img = bdsf.process_image(image_name, mean_map='zero', rms_box=rmsbox,
-                                     thresh_pix=threshpix, thresh_isl=threshisl,
-                                     atrous_do=atrous_do, ini_method='curvature', thresh='hard',
-                                     adaptive_rms_box=adaptive_rmsbox, adaptive_thresh=adaptive_thresh,
-                                     rms_box_bright=rmsbox_bright, rms_map=True, quiet=True,
-                                     atrous_jmax=atrous_jmax, stop_at='isl')
-
-            # Find min and max pixels
-            max_neg_val = abs(np.min(img.ch0_arr))
-            max_neg_pos = np.where(img.ch0_arr == np.min(img.ch0_arr))
-            max_pos_val = abs(np.max(img.ch0_arr))
-            max_pos_pos = np.where(img.ch0_arr == np.max(img.ch0_arr))
-
-            # Estimate new thresh_isl from min pixel value's sigma, but don't let
-            # it get higher than 1/2 of the peak's sigma
-            threshisl_neg = 2.0 * max_neg_val / img.rms_arr[max_neg_pos][0]
-            max_sigma = max_pos_val / img.rms_arr[max_pos_pos][0]
-            if threshisl_neg > max_sigma / 2.0:
-                threshisl_neg = max_sigma / 2.0
-
-            # Use the new threshold only if it is larger than the user-specified one
-            if threshisl_neg > threshisl:
-                threshisl = threshisl_neg
-
-        if iterate_threshold:
-            # Start with given threshold and lower it until we get at least one island
-            nisl = 0
-            while nisl == 0:
-                img = bdsf.process_image(image_name, mean_map='zero', rms_box=rmsbox,
-                                         thresh_pix=threshpix, thresh_isl=threshisl,
-                                         atrous_do=atrous_do, ini_method='curvature', thresh='hard',
-                                         adaptive_rms_box=adaptive_rmsbox, adaptive_thresh=adaptive_thresh,
-                                         rms_box_bright=rmsbox_bright, rms_map=True, quiet=True,
-                                         atrous_jmax=atrous_jmax)
-                nisl = img.nisl
-                threshpix /= 1.2
-                threshisl /= 1.2
-                if threshpix < 5.0:
-                    break
-        else:
-            img = bdsf.process_image(image_name, mean_map='zero', rms_box=rmsbox,
-                                     thresh_pix=threshpix, thresh_isl=threshisl,
-                                     atrous_do=atrous_do, ini_method='curvature', thresh='hard',
-                                     adaptive_rms_box=adaptive_rmsbox, adaptive_thresh=adaptive_thresh,
-                                     rms_box_bright=rmsbox_bright, rms_map=True, quiet=True,
-                                     atrous_jmax=atrous_jmax)
+            if hdulist is not None:
+                hdulist.close()
+            else:
+                input_img.putdata(data)
+
+        rms_maps = {}
+        try:
+            if reuse_rms_maps and (use_adaptive_threshold or iterate_threshold):
+                # Compute the background mean and rms maps once and give them to
+                # all following PyBDSF runs, which then don't recompute them
+                img = find_islands(engine, image_name, mean_map='zero', rms_box=rmsbox,
+                                   thresh_pix=threshpix, thresh_isl=threshisl,
+                                   atrous_do=atrous_do, ini_method='curvature', thresh='hard',
+                                   adaptive_rms_box=adaptive_rmsbox, adaptive_thresh=adaptive_thresh,
+                                   rms_box_bright=rmsbox_bright, rms_map=True, quiet=True,
+                                   atrous_jmax=atrous_jmax, stop_at='isl')
+                rms_maps['rmsmean_map_filename'] = [mask_name + '.mean_map.fits', mask_name + '.rms_map.fits']
+                img.export_image(img_type='mean', outfile=rms_maps['rmsmean_map_filename'][0],
+                                 img_format='fits', clobber=True)
+                img.export_image(img_type='rms', outfile=rms_maps['rmsmean_map_filename'][1],
+                                 img_format='fits', clobber=True)
+
+            if use_adaptive_threshold:
+                if not rms_maps:
+                    # Get an estimate of the rms
+                    img = find_islands(engine, image_name, mean_map='zero', rms_box=rmsbox,
+                                       thresh_pix=threshpix, thresh_isl=threshisl,
+                                       atrous_do=atrous_do, ini_method='curvature', thresh='hard',
+                                       adaptive_rms_box=adaptive_rmsbox, adaptive_thresh=adaptive_thresh,
+                                       rms_box_bright=rmsbox_bright, rms_map=True, quiet=True,
+                                       atrous_jmax=atrous_jmax, stop_at='isl')
+
+                # Find min and max pixels
+                max_neg_val = abs(np.min(img.ch0_arr))
+                max_neg_pos = np.where(img.ch0_arr == np.min(img.ch0_arr))
+                max_pos_val = abs(np.max(img.ch0_arr))
+                max_pos_pos = np.where(img.ch0_arr == np.max(img.ch0_arr))
+
+                # Estimate new thresh_isl from min pixel value's sigma, but don't let
+                # it get higher than 1/2 of the peak's sigma
+                threshisl_neg = 2.0 * max_neg_val / img.rms_arr[max_neg_pos][0]
+                max_sigma = max_pos_val / img.rms_arr[max_pos_pos][0]
+                if threshisl_neg > max_sigma / 2.0:
+                    threshisl_neg = max_sigma / 2.0
+
+                # Use the new threshold only if it is larger than the user-specified one
+                if threshisl_neg > threshisl:
+                    threshisl = threshisl_neg
+
+            if iterate_threshold:
+                # Start with given threshold and lower it until we get at least one island
+                nisl = 0
+                while nisl == 0:
+                    img = find_islands(engine, image_name, mean_map='zero', rms_box=rmsbox,
+                                       thresh_pix=threshpix, thresh_isl=threshisl,
+                                       atrous_do=atrous_do, ini_method='curvature', thresh='hard',
+                                       adaptive_rms_box=adaptive_rmsbox, adaptive_thresh=adaptive_thresh,
+                                       rms_box_bright=rmsbox_bright, rms_map=True, quiet=True,
+                                       atrous_jmax=atrous_jmax, **rms_maps)
+                    nisl = img.nisl
+                    threshpix /= 1.2
+                    threshisl /= 1.2
+                    if threshpix < 5.0:
+                        break
+            else:
+                img = find_islands(engine, image_name, mean_map='zero', rms_box=rmsbox,
+                                   thresh_pix=threshpix, thresh_isl=threshisl,
+                                   atrous_do=atrous_do, ini_method='curvature', thresh='hard',
+                                   adaptive_rms_box=adaptive_rmsbox, adaptive_thresh=adaptive_thresh,
+                                   rms_box_bright=rmsbox_bright, rms_map=True, quiet=True,
+                                   atrous_jmax=atrous_jmax, **rms_maps)
+        finally:
+            # Remove the maps also if a run failed, so that they are never reused by
+            # a later run on the same image
+            for map_name in rms_maps.get('rmsmean_map_filename', []):
+                if os.path.exists(map_name):
+                    os.remove(map_name)
 
         if img.nisl == 0:
             if region_file is None or region_file == '[]':
@@ -646,38 +998,49 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
         or skip_source_detection):
         # Alter the mask in various ways
         if skip_source_detection:
-            # Read the image
-            mask_im = pim.image(image_name)
+            # Start from the image
+            input_name = image_name
         else:
-            # Read the PyBDSF mask
-            mask_im = pim.image(mask_name)
-        data = mask_im.getdata()
-        coordsys = mask_im.coordinates()
-        if reference_ra_deg is not None and reference_dec_deg is not None:
-            values = coordsys.get_referencevalue()
-            values[2][0] = reference_dec_deg/180.0*np.pi
-            values[2][1] = reference_ra_deg/180.0*np.pi
-            coordsys.set_referencevalue(values)
-        imshape = mask_im.shape()
-        del(mask_im)
-
-        if pad_to_size is not None:
-            imsize = pad_to_size
-            coordsys['direction'].set_referencepixel([imsize/2, imsize/2])
-            pixmin = (imsize - imshape[2]) / 2
-            if pixmin < 0:
-                print("The padded size must be larger than the original size.")
-                sys.exit(1)
-            pixmax = pixmin + imshape[2]
-            data_pad = np.zeros((1, 1, imsize, imsize), dtype=np.float32)
-            data_pad[0, 0, pixmin:pixmax, pixmin:pixmax] = data[0, 0]
-            new_mask = pim.image('', shape=(1, 1, imsize, imsize), coordsys=coordsys)
-            new_mask.putdata(data_pad)
+            # Start from the PyBDSF mask
+            input_name = mask_name
+        if img_format == 'fits' and is_float_fits(input_name):
+            # Write the (padded) FITS mask once and edit it through a memory map
+            hdulist, data = make_fits_mask(input_name, mask_name, pad_to_size=pad_to_size,
+                                           reference_ra_deg=reference_ra_deg,
+                                           reference_dec_deg=reference_dec_deg,
+                                           copy_data=not skip_source_detection)
+            wcs = WCS(hdulist[0].header).celestial
         else:
-            new_mask = pim.image('', shape=imshape, coordsys=coordsys)
-            new_mask.putdata(data)
+            mask_im = pim.image(input_name)
+            data = mask_im.getdata()
+            coordsys = mask_im.coordinates()
+            if reference_ra_deg is not None and reference_dec_deg is not None:
+                values = coordsys.get_referencevalue()
+                values[2][0] = reference_dec_deg/180.0*np.pi
+                values[2][1] = reference_ra_deg/180.0*np.pi
+                coordsys.set_referencevalue(values)
+            imshape = mask_im.shape()
+            del(mask_im)
+
+            if pad_to_size is not None:
+                imsize = pad_to_size
+                coordsys['direction'].set_referencepixel([imsize/2, imsize/2])
+                pixmin = (imsize - imshape[2]) / 2
+                if pixmin < 0:
+                    print("The padded size must be larger than the original size.")
+                    sys.exit(1)
+                pixmax = pixmin + imshape[2]
+                data_pad = np.zeros((1, 1, imsize, imsize), dtype=np.float32)
+                data_pad[0, 0, pixmin:pixmax, pixmin:pixmax] = data[0, 0]
+                new_mask = pim.image('', shape=(1, 1, imsize, imsize), coordsys=coordsys)
+                new_mask.putdata(data_pad)
+            else:
+                new_mask = pim.image('', shape=imshape, coordsys=coordsys)
+                new_mask.putdata(data)
 
-        data = new_mask.getdata()
+            data = new_mask.getdata()
+            wcs = get_direction_wcs(new_mask)
+            hdulist = None
 
         if skip_source_detection:
             # Mask all pixels
@@ -686,30 +1049,12 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
         if vertices_file is not None:
             # Modify the clean mask to exclude regions outside of the polygon
             vertices = read_vertices(vertices_file)
-            RAverts = vertices[0]
-            Decverts = vertices[1]
-            xvert = []
-            yvert = []
-            for RAvert, Decvert in zip(RAverts, Decverts):
-                try:
-                    pixels = new_mask.topixel([0, 1, Decvert*np.pi/180.0,
-                                               RAvert*np.pi/180.0])
-                except:
-                    pixels = new_mask.topixel([1, 1, Decvert*np.pi/180.0,
-                                               RAvert*np.pi/180.0])
-                xvert.append(pixels[2]) # x -> Dec
-                yvert.append(pixels[3]) # y -> RA
+            xvert, yvert = radec_to_pixel(wcs, vertices[0], vertices[1])
             poly = Polygon(xvert, yvert)
 
-            # Find masked regions
-            masked_ind = np.where(data[0, 0])
-
-            # Find distance to nearest poly edge and unmask those that
-            # are outside the facet (dist < 0)
-            dist = poly.is_inside(masked_ind[0], masked_ind[1])
-            outside_ind = np.where(dist < 0.0)
-            if len(outside_ind[0]) > 0:
-                data[0, 0, masked_ind[0][outside_ind], masked_ind[1][outside_ind]] = 0
+            # Unmask the pixels that are outside the facet (pixels on the
+            # facet edge are kept)
+            data[0, 0][~poly.rasterize(data.shape[2:], include_boundary=True)] = 0
 
         if trim_by > 0.0:
             sh = np.shape(data)
@@ -721,23 +1066,21 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
 
         if region_file is not None and region_file != '[]':
             # Merge the CASA regions with the mask
-            casa_polys = read_casa_polys(region_file.strip('[]"'), new_mask)
+            casa_polys = read_casa_polys(region_file.strip('[]"'), wcs)
             for poly in casa_polys:
-                # Find unmasked regions
-                unmasked_ind = np.where(data[0, 0] == 0)
-
-                # Find distance to nearest poly edge and mask those that
-                # are inside the casa region (dist > 0)
-                dist = poly.is_inside(unmasked_ind[0], unmasked_ind[1])
-                inside_ind = np.where(dist > 0.0)
-                if len(inside_ind[0]) > 0:
-                    data[0, 0, unmasked_ind[0][inside_ind], unmasked_ind[1][inside_ind]] = 1
+                # Mask the unmasked pixels that are inside the casa region
+                # (pixels on the region edge are not)
+                inside = poly.rasterize(data.shape[2:])
+                data[0, 0][inside & (data[0, 0] == 0)] = 1
 
         # Save changes
-        new_mask.putdata(data)
-        if img_format == 'fits':
+        if hdulist is not None:
+            hdulist.close()
+        elif img_format == 'fits':
+            new_mask.putdata(data)
             new_mask.tofits(mask_name, overwrite=True)
         elif img_format == 'casa':
+            new_mask.putdata(data)
             new_mask.saveas(mask_name, overwrite=True)
         else:
             print('Output image format "{}" not understood.'.format(img_format))
@@ -779,6 +1122,10 @@ if __name__ == '__main__':
     parser.add_argument('-j', '--atrous_jmax', help='Max wavelet scale', type=int, default=3)
     parser.add_argument('-z', '--pad_to_size', help='pad mask to this size', type=int, default=None)
     parser.add_argument('-s', '--skip_source_detection', help='skip source detection', type=bool, default=False)
+    parser.add_argument('--reuse_rms_maps', help='compute the rms and mean maps only once if PyBDSF is run more '
+        'than once', type=bool, default=False)
+    parser.add_argument('-e', '--engine', help='source finder: pybdsf, native (fast, islands only) or validate '
+        '(pybdsf, compared to native)', type=str, default='pybdsf')
 
     args = parser.parse_args()
     erg = main(args.image_name, args.mask_name, atrous_do=args.atrous_do,
@@ -789,5 +1136,6 @@ if __name__ == '__main__':
                threshold_format=args.threshold_format, trim_by=args.trim_by,
                vertices_file=args.vertices_file, atrous_jmax=args.atrous_jmax,
                pad_to_size=args.pad_to_size, skip_source_detection=args.skip_source_detection,
-               region_file=args.region_file)
+               region_file=args.region_file, reuse_rms_maps=args.reuse_rms_maps,
+               engine=args.engine)
     print erg
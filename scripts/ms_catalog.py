@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+"""
+Catalog of MeasurementSet metadata in an SQLite sidecar
+
+Opening an MS and its subtables is slow on network storage, and several steps
+only need the same few values of every MS: the frequency setup, the start
+time and the station diameter. This module reads them once, in parallel, and
+stores them in an SQLite file next to the MSs (ms_catalog.sqlite in the
+directory of the MS, or the file given by the environment variable
+PREFACTOR_MS_CATALOG). An entry is reused as long as the path, the latest
+modification time and the total size of the files of the main table and of
+its SPECTRAL_WINDOW, ANTENNA and OBSERVATION subtables are unchanged.
+
+If the catalog cannot be written (e.g. a read-only directory), the metadata
+is read from the MSs and used without caching.
+"""
+import os
+import sqlite3
+import multiprocessing
+import numpy as np
+import pyrap.tables as pt
+import resource_budget
+
+catalog_name = 'ms_catalog.sqlite'
+catalog_version = 1
+subtables = ['SPECTRAL_WINDOW', 'ANTENNA', 'OBSERVATION']
+fields = ['ref_freq', 'total_bandwidth', 'nchan', 'chan_freq', 'chan_width', 'start_time', 'dish_diameter']
+
+########################################################################
+def get_signature(ms):
+    """
+    Return (mtime, size) of the files of the main table and the used subtables
+    """
+    mtime = 0.
+    size = 0
+    for directory in [ms] + [os.path.join(ms, sub) for sub in subtables]:
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                mtime = max(mtime, stat.st_mtime)
+                size += stat.st_size
+    return mtime, size
+
+########################################################################
+def get_start_time(ms, nsample=1000):
+    """
+    Return the minimum of the TIME column of an MS without reading all of it
+
+    The minimum of the first nsample rows is used if it lies in the first
+    integration of the OBSERVATION::TIME_RANGE, i.e. if no earlier timeslot
+    can exist. Otherwise (unsorted data, wrong or missing TIME_RANGE) the
+    whole TIME column is read.
+    """
+    t = pt.table(ms, ack=False)
+    nrows = t.nrows()
+    start_time = np.min(t.getcol('TIME', 0, min(nsample, nrows)))
+    interval = t.getcell('INTERVAL', 0)
+    obs = pt.table(ms+'::OBSERVATION', ack=False)
+    if obs.nrows() > 0:
+        range_start = obs.col('TIME_RANGE')[0][0]
+    else:
+        range_start = None
+    obs.close()
+    if nrows > nsample and (range_start is None or not 0 <= start_time - range_start < interval):
+        print('ms_catalog: start time of %s does not match OBSERVATION::TIME_RANGE, reading the TIME column.' % ms)
+        start_time = np.min(t.getcol('TIME'))
+    t.close()
+    return start_time
+
+########################################################################
+def read_ms_metadata(ms):
+    """
+    Read the metadata of an MS from its tables
+
+    Returns
+    -------
+    metadata : dict
+        ref_freq, total_bandwidth, nchan (NUM_CHAN), chan_freq and chan_width
+        (arrays) of the first spectral window, start_time (minimum of TIME)
+        and dish_diameter of the first station
+    """
+    sw = pt.table(ms+'::SPECTRAL_WINDOW', ack=False)
+    metadata = {'ref_freq': sw.col('REF_FREQUENCY')[0],
+                'total_bandwidth': sw.col('TOTAL_BANDWIDTH')[0],
+                'nchan': int(sw.col('NUM_CHAN')[0]),
+                'chan_freq': np.array(sw.col('CHAN_FREQ')[0], dtype=np.float64),
+                'chan_width': np.array(sw.col('CHAN_WIDTH')[0], dtype=np.float64)}
+    sw.close()
+    metadata['start_time'] = get_start_time(ms)
+    ant = pt.table(ms+'::ANTENNA', ack=False)
+    metadata['dish_diameter'] = float(ant.col('DISH_DIAMETER')[0])
+    ant.close()
+    return metadata
+
+########################################################################
+def read_worker(ms):
+    """
+    Read the signature and metadata of one MS (for the pool)
+    """
+    return get_signature(ms), read_ms_metadata(ms)
+
+########################################################################
+def get_catalog_path(ms):
+    """
+    Return the path of the catalog that holds the metadata of this MS
+    """
+    if os.environ.get('PREFACTOR_MS_CATALOG'):
+        return os.environ['PREFACTOR_MS_CATALOG']
+    return os.path.join(os.path.dirname(os.path.abspath(ms)), catalog_name)
+
+########################################################################
+def open_catalog(path):
+    """
+    Open (and create if needed) a catalog, return None if that is not possible
+    """
+    try:
+        db = sqlite3.connect(path, timeout=60)
+        if db.execute('PRAGMA user_version').fetchone()[0] != catalog_version:
+            db.execute('DROP TABLE IF EXISTS ms')
+            db.execute('PRAGMA user_version = %i' % catalog_version)
+        db.execute('CREATE TABLE IF NOT EXISTS ms (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, '
+                   'ref_freq REAL, total_bandwidth REAL, nchan INTEGER, chan_freq BLOB, '
+                   'chan_width BLOB, start_time REAL, dish_diameter REAL)')
+        db.commit()
+        return db
+    except sqlite3.Error as e:
+        print('ms_catalog: cannot use catalog %s (%s), reading the MSs directly.' % (path, e))
+        return None
+
+########################################################################
+def to_row(path, signature, metadata):
+    """
+    Convert metadata to a catalog row
+    """
+    return (path, signature[0], signature[1], float(metadata['ref_freq']),
+            float(metadata['total_bandwidth']), metadata['nchan'],
+            sqlite3.Binary(metadata['chan_freq'].tobytes()),
+            sqlite3.Binary(metadata['chan_width'].tobytes()),
+            float(metadata['start_time']), metadata['dish_diameter'])
+
+########################################################################
+def from_row(row):
+    """
+    Convert a catalog row (without path, mtime and size) to metadata
+    """
+    metadata = dict(zip(fields, row))
+    metadata['chan_freq'] = np.frombuffer(bytes(metadata['chan_freq']), dtype=np.float64)
+    metadata['chan_width'] = np.frombuffer(bytes(metadata['chan_width']), dtype=np.float64)
+    return metadata
+
+########################################################################
+def get_metadata(mslist, ncpu=None, use_catalog=True):
+    """
+    Return the metadata of a list of MSs, from the catalog where possible
+
+    MSs that are not (or no longer validly) in the catalog are read in
+    parallel and added to it.
+
+    Parameters
+    ----------
+    mslist : list of str
+        MSs to get the metadata of
+    ncpu : int, optional
+        Number of processes to read MSs with, default is the CPU budget of the job
+    use_catalog : bool, optional
+        If False, always read the MSs and do not touch the catalog
+
+    Returns
+    -------
+    metadata : list of dict
+        Metadata of every MS (see read_ms_metadata), in the order of mslist
+    """
+    paths = [os.path.abspath(ms) for ms in mslist]
+    signatures = dict((path, get_signature(path)) for path in set(paths))
+    results = {}
+
+    catalogs = {}
+    if use_catalog:
+        for path in set(paths):
+            catalogs.setdefault(get_catalog_path(path), []).append(path)
+        for catalog_path in catalogs.keys():
+            db = open_catalog(catalog_path)
+            catalogs[catalog_path] = (db, catalogs[catalog_path])
+            if db is None:
+                continue
+            for path in catalogs[catalog_path][1]:
+                row = db.execute('SELECT mtime, size, ' + ', '.join(fields) + ' FROM ms WHERE path = ?',
+                                 (path,)).fetchone()
+                if row is not None and tuple(row[:2]) == signatures[path]:
+                    results[path] = from_row(row[2:])
+
+    missing = sorted(set(paths) - set(results.keys()))
+    if missing:
+        if ncpu is None:
+            ncpu = resource_budget.get_cpu_budget()
+        ncpu = max(min(int(ncpu), len(missing)), 1)
+        if ncpu > 1:
+            pool = multiprocessing.Pool(ncpu)
+            read = pool.map(read_worker, missing)
+            pool.close()
+            pool.join()
+        else:
+            read = [read_worker(path) for path in missing]
+        for path, (signature, metadata) in zip(missing, read):
+            results[path] = metadata
+            signatures[path] = signature
+
+    for catalog_path, (db, catalog_paths) in catalogs.items():
+        if db is None:
+            continue
+        rows = [to_row(path, signatures[path], results[path]) for path in catalog_paths if path in missing]
+        try:
+            if rows:
+                db.executemany('INSERT OR REPLACE INTO ms VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                db.commit()
+        except sqlite3.Error as e:
+            print('ms_catalog: cannot update catalog %s (%s).' % (catalog_path, e))
+        db.close()
+
+    return [results[path] for path in paths]
+
+########################################################################
+def get_ms_metadata(ms, use_catalog=True):
+    """
+    Return the metadata of a single MS, from the catalog where possible
+    """
+    return get_metadata([ms], ncpu=1, use_catalog=use_catalog)[0]
+
+########################################################################
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Fill the MS metadata catalog and print its contents.')
+    parser.add_argument('ms_files', nargs='+', help='MSs to catalog')
+    parser.add_argument('-n', '--ncpu', type=int, default=None, help='Number of processes (default: CPU budget of the job)')
+    args = parser.parse_args()
+
+    for ms, metadata in zip(args.ms_files, get_metadata(args.ms_files, args.ncpu)):
+        print('%s: %.6f MHz, %i channels, start time %.3f' % (ms, metadata['ref_freq'] / 1e6,
+                                                            metadata['nchan'], metadata['start_time']))
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""
+Memory and CPU budget of the current job
+
+The budget is the smallest of what the host offers (MemAvailable, CPU
+affinity), the limits of the cgroup (v1 or v2) the process runs in and the
+allocation of the SLURM job, if any. An explicit value, given as an argument
+or via the environment variables PREFACTOR_MEMORY (in GB, or with a K/M/G/T
+suffix) and PREFACTOR_NCPU, overrides all of these.
+
+Run as a script to print the budget and where it comes from.
+"""
+import os
+import multiprocessing
+
+cgroup_root = '/sys/fs/cgroup'
+
+########################################################################
+def read_value(path):
+    """
+    Return the first line of a (cgroup or proc) file, or None if it cannot be read
+    """
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except (IOError, OSError):
+        return None
+
+########################################################################
+def parse_size(value):
+    """
+    Convert a size like '64', '64G', '65536M' or '64GB' to bytes, plain numbers are GB
+    """
+    value = str(value).strip().upper().rstrip('B')
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value) * 1024**3)
+
+########################################################################
+def get_cgroup_dirs(controller):
+    """
+    Return the cgroup directories of this process for the given controller,
+    from the innermost to the cgroup root (limits of every level apply)
+    """
+    lines = []
+    try:
+        with open('/proc/self/cgroup') as f:
+            lines = [line.strip().split(':', 2) for line in f if line.strip()]
+    except (IOError, OSError):
+        pass
+    dirs = []
+    for hierarchy, controllers, path in lines:
+        if hierarchy == '0' and controllers == '':
+            # cgroup v2, one unified hierarchy (under unified/ on hybrid systems)
+            mount = cgroup_root
+            if os.path.isdir(os.path.join(cgroup_root, 'unified')):
+                mount = os.path.join(cgroup_root, 'unified')
+        elif controller in controllers.split(','):
+            # cgroup v1, one hierarchy per (group of) controller(s)
+            mount = os.path.join(cgroup_root, controllers)
+            if not os.path.isdir(mount):
+                mount = os.path.join(cgroup_root, controller)
+        else:
+            continue
+        path = path.strip('/')
+        while True:
+            directory = os.path.normpath(os.path.join(mount, path))
+            if os.path.isdir(directory) and directory not in dirs:
+                dirs.append(directory)
+            if path == '':
+                break
+            path = os.path.dirname(path)
+    return dirs
+
+########################################################################
+def get_host_memory():
+    """
+    Return MemAvailable and MemTotal of /proc/meminfo in bytes
+    """
+    meminfo = {}
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.split()[0]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    total = meminfo.get('MemTotal', 0)
+    return meminfo.get('MemAvailable', meminfo.get('MemFree', total)), total
+
+########################################################################
+def get_cgroup_memory(host_total):
+    """
+    Return the memory still available within the cgroup limits in bytes, or None
+
+    The available memory is the limit minus the working set, i.e. the usage
+    without the inactive page cache that the kernel can reclaim.
+    """
+    available = None
+    for directory in get_cgroup_dirs('memory'):
+        for limit_file, usage_file, inactive_key in [('memory.max', 'memory.current', 'inactive_file'),
+                                                     ('memory.limit_in_bytes', 'memory.usage_in_bytes', 'total_inactive_file')]:
+            limit = read_value(os.path.join(directory, limit_file))
+            if limit is None or limit == 'max' or int(limit) >= host_total > 0:
+                continue
+            usage = int(read_value(os.path.join(directory, usage_file)) or 0)
+            try:
+                with open(os.path.join(directory, 'memory.stat')) as f:
+                    stat = dict(line.split() for line in f if len(line.split()) == 2)
+                usage -= int(stat.get(inactive_key, 0))
+            except (IOError, OSError, ValueError):
+                pass
+            free = max(int(limit) - max(usage, 0), 0)
+            if available is None or free < available:
+                available = free
+    return available
+
+########################################################################
+def get_slurm_memory():
+    """
+    Return the memory allocated to the SLURM job on this node in bytes, or None
+    """
+    if 'SLURM_MEM_PER_NODE' in os.environ:
+        return int(os.environ['SLURM_MEM_PER_NODE']) * 1024**2
+    if 'SLURM_MEM_PER_CPU' in os.environ:
+        ncpu = get_slurm_cpus() or 1
+        return int(os.environ['SLURM_MEM_PER_CPU']) * 1024**2 * ncpu
+    return None
+
+########################################################################
+def get_host_cpus():
+    """
+    Return the number of CPUs this process may run on
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+########################################################################
+def get_cgroup_cpus():
+    """
+    Return the number of CPUs allowed by the cgroup CPU quota (rounded up), or None
+    """
+    ncpu = None
+    for directory in get_cgroup_dirs('cpu'):
+        quota = period = None
+        value = read_value(os.path.join(directory, 'cpu.max'))
+        if value is not None:
+            quota, period = (value.split() + ['100000'])[:2]
+        else:
+            quota = read_value(os.path.join(directory, 'cpu.cfs_quota_us'))
+            period = read_value(os.path.join(directory, 'cpu.cfs_period_us'))
+        if quota is None or period is None or quota in ['max', '-1']:
+            continue
+        quota_cpus = max(int(-(-int(quota) // int(period))), 1)
+        if ncpu is None or quota_cpus < ncpu:
+            ncpu = quota_cpus
+    return ncpu
+
+########################################################################
+def get_slurm_cpus():
+    """
+    Return the number of CPUs allocated to the SLURM job (step) on this node, or None
+    """
+    for key in ['SLURM_CPUS_PER_TASK', 'SLURM_CPUS_ON_NODE']:
+        if key in os.environ:
+            try:
+                return int(os.environ[key].split('(')[0].split(',')[0])
+            except ValueError:
+                pass
+    return None
+
+########################################################################
+def get_memory_budget(memory=None, verbose=False):
+    """
+    Return the memory the job may use in bytes
+
+    Parameters
+    ----------
+    memory : float or str, optional
+        Explicit budget in GB (or with a K/M/G/T suffix), overrides everything else.
+        If not given, the environment variable PREFACTOR_MEMORY is used if set.
+    verbose : bool
+        Also return a dict with all candidate values
+
+    Returns
+    -------
+    budget : int
+        Smallest of the host, cgroup and SLURM values in bytes
+    """
+    if memory is None:
+        memory = os.environ.get('PREFACTOR_MEMORY')
+    available, total = get_host_memory()
+    candidates = {'host': available,
+                  'cgroup': get_cgroup_memory(total),
+                  'slurm': get_slurm_memory()}
+    if memory is not None and str(memory).strip() != '':
+        candidates['override'] = parse_size(memory)
+        budget = candidates['override']
+    else:
+        budget = min([value for value in candidates.values() if value is not None])
+    if verbose:
+        return budget, candidates
+    return budget
+
+########################################################################
+def get_cpu_budget(ncpu=None, verbose=False):
+    """
+    Return the number of processes the job should run in parallel
+
+    Parameters
+    ----------
+    ncpu : int, optional
+        Explicit number of CPUs, overrides everything else. If not given, the
+        environment variable PREFACTOR_NCPU is used if set.
+    verbose : bool
+        Also return a dict with all candidate values
+
+    Returns
+    -------
+    budget : int
+        Smallest of the host, cgroup and SLURM values (at least 1)
+    """
+    if ncpu is None:
+        ncpu = os.environ.get('PREFACTOR_NCPU')
+    candidates = {'host': get_host_cpus(),
+                  'cgroup': get_cgroup_cpus(),
+                  'slurm': get_slurm_cpus()}
+    if ncpu is not None and str(ncpu).strip() != '':
+        candidates['override'] = int(ncpu)
+        budget = candidates['override']
+    else:
+        budget = min([value for value in candidates.values() if value is not None])
+    if verbose:
+        return max(budget, 1), candidates
+    return max(budget, 1)
+
+########################################################################
+if __name__ == '__main__':
+    memory, memory_candidates = get_memory_budget(verbose=True)
+    ncpu, cpu_candidates = get_cpu_budget(verbose=True)
+    print('Memory budget: %.2f GB' % (memory / 1024.**3))
+    for key in sorted(memory_candidates):
+        if memory_candidates[key] is not None:
+            print('  %-8s: %.2f GB' % (key, memory_candidates[key] / 1024.**3))
+    print('CPU budget: %i' % ncpu)
+    for key in sorted(cpu_candidates):
+        if cpu_candidates[key] is not None:
+            print('  %-8s: %i' % (key, cpu_candidates[key]))
@@ -2,11 +2,13 @@
 """
 Script to sort a list of MSs by into frequency groups by time-stamp
 """
-import pyrap.tables as pt
 import sys, os
 import numpy as np
 from lofarpipe.support.data_map import DataMap
 from lofarpipe.support.data_map import DataProduct
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ms_catalog
+import host_assignment
 
 def _calc_edge_chans(inmap, numch, edgeFactor=32):
     """
@@ -64,7 +66,7 @@ def input2int(invar):
 
     
 def main(ms_input, filename=None, mapfile_dir=None, numSB=-1, hosts=None, NDPPPfill=True, target_path=None, stepname=None,
-         mergeLastGroup=False, truncateLastSBs=True, firstSB=None):
+         mergeLastGroup=False, truncateLastSBs=True, firstSB=None, host_mounts=None):
     """
     Check a list of MS files for missing frequencies
 
@@ -107,6 +109,10 @@ def main(ms_input, filename=None, mapfile_dir=None, numSB=-1, hosts=None, NDPPPf
         If set, then reference the grouping of files to this station-subband. As if a file 
         with this station-subband would be included in the input files.
         (For HBA-low, i.e. 0 -> 100MHz, 55 -> 110.74MHz, 512 -> 200MHz)
+    host_mounts : dict or str, optional
+        Mounts of the hosts, as a dict or as a string "host1:/mnt/a,/mnt/b;host2:/mnt/c".
+        Every group goes to the host that stores most of its files (judged from this map
+        or from host names in the paths) while balancing the input size over the hosts.
 
     Returns
     -------
@@ -149,20 +155,19 @@ def main(ms_input, filename=None, mapfile_dir=None, numSB=-1, hosts=None, NDPPPf
         hosts = [h.strip(' \'\"') for h in hosts.strip('[]').split(',')]
     if not hosts:
         hosts = ['localhost']
-    numhosts = len(hosts)
     print "sort_times_into_freqGroups: Working on",len(ms_list),"files (including flagged files)."
 
+    # get start time and frequency info of the files selected by a previous step
+    selected = [ms for ms in ms_list if ms.lower() != 'none']
+    metadata = dict(zip(selected, ms_catalog.get_metadata(selected)))
+
     time_groups = {}
     # sort by time
     for i, ms in enumerate(ms_list):
         # work only on files selected by a previous step
         if ms.lower() != 'none':
-            # use the slower but more reliable way:
-            obstable = pt.table(ms, ack=False)
-            timestamp = int(round(np.min(obstable.getcol('TIME'))))
-            #obstable = pt.table(ms+'::OBSERVATION', ack=False)
-            #timestamp = int(round(obstable.col('TIME_RANGE')[0][0]))
-            obstable.close()
+            # minimum of the TIME column (OBSERVATION::TIME_RANGE alone is not reliable)
+            timestamp = int(round(metadata[ms]['start_time']))
             if timestamp in time_groups:
                 time_groups[timestamp]['files'].append(ms)
             else:
@@ -178,21 +183,19 @@ def main(ms_input, filename=None, mapfile_dir=None, numSB=-1, hosts=None, NDPPPf
         freqs = []
         for ms in time_groups[time]['files']:
             # Get the frequency info
-            sw = pt.table(ms+'::SPECTRAL_WINDOW', ack=False)
-            freq = sw.col('REF_FREQUENCY')[0]            
+            freq = metadata[ms]['ref_freq']
             if first:
-                file_bandwidth = sw.col('TOTAL_BANDWIDTH')[0]
-                nchans = sw.col('CHAN_WIDTH')[0].shape[0]
-                chwidth = sw.col('CHAN_WIDTH')[0][0]
+                file_bandwidth = metadata[ms]['total_bandwidth']
+                nchans = metadata[ms]['chan_width'].shape[0]
+                chwidth = metadata[ms]['chan_width'][0]
                 freqset = set([freq])
                 first = False
             else:
-                assert file_bandwidth == sw.col('TOTAL_BANDWIDTH')[0]
-                assert nchans == sw.col('CHAN_WIDTH')[0].shape[0]
-                assert chwidth == sw.col('CHAN_WIDTH')[0][0]
+                assert file_bandwidth == metadata[ms]['total_bandwidth']
+                assert nchans == metadata[ms]['chan_width'].shape[0]
+                assert chwidth == metadata[ms]['chan_width'][0]
                 freqset.add(freq)
             freqs.append(freq)
-            sw.close()
         time_groups[time]['freq_names'] = zip(freqs,time_groups[time]['files'])
         time_groups[time]['freq_names'].sort(key=lambda pair: pair[0])
         #time_groups[time]['files'] = [name for (freq,name) in freq_names]
@@ -252,38 +255,57 @@ def main(ms_input, filename=None, mapfile_dir=None, numSB=-1, hosts=None, NDPPPf
     
     print "sort_times_into_freqGroups: Will create",ngroups,"group(s) with",numSB,"file(s) each."
 
-    hostID = 0
+    # lower frequencies of the file-slots of all groups (the slots of group groupIdx
+    # are slot_lows[group_starts[groupIdx]:group_starts[groupIdx+1]])
+    slot_lows = [np.arange(freqborders[groupIdx],freqborders[groupIdx+1],freq_width) for groupIdx in xrange(ngroups)]
+    group_starts = np.cumsum([0]+[len(lows) for lows in slot_lows])
+    slot_lows = np.concatenate(slot_lows)
+    slot_highs = slot_lows+freq_width
+
+    groups = []
     for time in timestamps:
-        (freq,fname) = time_groups[time]['freq_names'].pop(0)
+        freqs = np.array([freq for (freq,fname) in time_groups[time]['freq_names']])
+        fnames = [fname for (freq,fname) in time_groups[time]['freq_names']]
+        numfiles = len(fnames)
+        # The files (sorted by frequency) go into increasing slots: each file into the first
+        # slot after the one of the previous file with lower_freq < freq < lower_freq+freq_width.
+        # The matching slots of a file are first_slot..last_slot.
+        first_slot = np.searchsorted(slot_highs, freqs, side='right')
+        last_slot = np.searchsorted(slot_lows, freqs, side='left')-1
+        slots = np.arange(numfiles)+np.maximum.accumulate(first_slot-np.arange(numfiles))
+        # a file that doesn't fit into a slot blocks all files after it
+        misfits = np.nonzero(slots > last_slot)[0]
+        if len(misfits) > 0:
+            numassigned = misfits[0]
+        else:
+            numassigned = numfiles
+        slot_files = [None]*len(slot_lows)
+        for fileIdx in xrange(numassigned):
+            slot_files[slots[fileIdx]] = fnames[fileIdx]
         for groupIdx in xrange(ngroups):
-            files = []
-            skip_this = True
-            filefreqs_low = np.arange(freqborders[groupIdx],freqborders[groupIdx+1],freq_width)
-            for lower_freq in filefreqs_low:
-                if freq > lower_freq and freq < lower_freq+freq_width:
-                    assert freq!=1e12
-                    files.append(fname)
-                    if len(time_groups[time]['freq_names'])>0:
-                        (freq,fname) = time_groups[time]['freq_names'].pop(0)
-                    else:
-                        (freq,fname) = (1e12,'This_shouldn\'t_show_up')
-                    skip_this = False
-                elif NDPPPfill:
-                    files.append('dummy.ms')
+            group_files = slot_files[group_starts[groupIdx]:group_starts[groupIdx+1]]
+            skip_this = all([fname is None for fname in group_files])
+            if NDPPPfill:
+                files = [fname if fname is not None else 'dummy.ms' for fname in group_files]
+            else:
+                files = [fname for fname in group_files if fname is not None]
             if not skip_this:
-                filemap.append(MultiDataProduct(hosts[hostID%numhosts], files, skip_this))
                 freqID = int((freqborders[groupIdx]+freqborders[groupIdx+1])/2e6)
                 groupname = time_groups[time]['basename']+'_%Xt_%dMHz.ms'%(time,freqID)
                 if type(stepname) is str:
                     groupname += stepname
                 if type(target_path) is str:
                     groupname = os.path.join(target_path,os.path.basename(groupname))
-                groupmap.append(DataProduct(hosts[hostID%numhosts],groupname, skip_this))
-        orphan_files = len(time_groups[time]['freq_names'])
-        if freq < 1e12:
-            orphan_files += 1
+                groups.append((files, groupname))
+        orphan_files = numfiles-numassigned
         if orphan_files > 0:
             print "sort_times_into_freqGroups: Had %d unassigned files in time-group %xt."%(orphan_files, time)
+
+    group_hosts = host_assignment.assign_hosts([[fname for fname in files if fname != 'dummy.ms'] for (files, groupname) in groups],
+                                               hosts, host_mounts=host_mounts)
+    for (files, groupname), host in zip(groups, group_hosts):
+        filemap.append(MultiDataProduct(host, files, False))
+        groupmap.append(DataProduct(host, groupname, False))
     filemapname = os.path.join(mapfile_dir, filename)
     filemap.save(filemapname)
     groupmapname = os.path.join(mapfile_dir, filename+'_groups')
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Tests of the baseline batching and the numerical tolerance of the smoothing
+backends of scripts/BLsmooth.py
+
+Run with: python -m unittest discover tests   (or: python -m pytest tests)
+"""
+import os, sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import BLsmooth
+
+# largest relative deviation from the double precision fir result
+single_tolerance = 1.e-6 # single precision path, same backend
+iir_data_tolerance = 5.e-2 # recursive backend, sigma >= 2 samples
+iir_weights_tolerance = 1.e-2
+
+def make_baseline(ntimes=400, nchan=3, ncorr=4, seed=0):
+    """
+    Return data (complex64), weights (float32) and flags of a synthetic baseline,
+    with some flagged and NaN samples.
+    """
+    rng = np.random.RandomState(seed)
+    shape = (ntimes, nchan, ncorr)
+    data = (rng.normal(size=shape) + 1j*rng.normal(size=shape)).astype(np.complex64)
+    data[rng.uniform(size=shape) < 0.01] = np.nan
+    weights = rng.uniform(0.5, 1.5, size=shape).astype(np.float32)
+    flags = rng.uniform(size=shape) < 0.05
+    return data, weights, flags
+
+def reference(data, weights, flags, stddev, onlyamp=False):
+    """
+    Smooth with the fir backend in double precision.
+    """
+    return BLsmooth.smooth_baseline(data.astype(np.complex128), weights.astype(np.float64),
+                                    flags.copy(), stddev, onlyamp, 'fir')
+
+def max_deviation(x, ref):
+    return np.nanmax(np.abs(x - ref)) / np.nanmax(np.abs(ref))
+
+class TestSmoothing(unittest.TestCase):
+
+    def test_iir_matches_fir(self):
+        data, weights, flags = make_baseline()
+        for stddev in (2., 5., 10., 30.):
+            refdata, refweights = reference(data, weights, flags, stddev)
+            iirdata, iirweights = BLsmooth.smooth_baseline(data.astype(np.complex128), weights.astype(np.float64),
+                                                           flags.copy(), stddev, False, 'iir')
+            self.assertLess(max_deviation(iirdata, refdata), iir_data_tolerance, 'sigma=%g' % stddev)
+            self.assertLess(max_deviation(iirweights, refweights), iir_weights_tolerance, 'sigma=%g' % stddev)
+
+    def test_single_matches_double(self):
+        data, weights, flags = make_baseline()
+        for backend in ('fir', 'iir'):
+            for onlyamp in (False, True):
+                for stddev in (0.6, 2., 10.):
+                    refdata, refweights = BLsmooth.smooth_baseline(data.astype(np.complex128), weights.astype(np.float64),
+                                                                   flags.copy(), stddev, onlyamp, backend)
+                    sdata, sweights = BLsmooth.smooth_baseline_single(data.copy(), weights.copy(), flags.copy(),
+                                                                      stddev, onlyamp, backend)
+                    self.assertEqual(sdata.dtype, np.complex64)
+                    self.assertEqual(sweights.dtype, np.float32)
+                    msg = 'backend=%s, onlyamp=%s, sigma=%g' % (backend, onlyamp, stddev)
+                    self.assertLess(max_deviation(sdata, refdata), single_tolerance, msg)
+                    self.assertLess(max_deviation(sweights, refweights), single_tolerance, msg)
+
+    def test_single_buffers_not_shared(self):
+        # without a buffers dict, every call must return new arrays
+        data, weights, flags = make_baseline()
+        first = BLsmooth.smooth_baseline_single(data.copy(), weights.copy(), flags.copy(), 2.)
+        saved = [ x.copy() for x in first ]
+        data, weights, flags = make_baseline(seed=1)
+        second = BLsmooth.smooth_baseline_single(data.copy(), weights.copy(), flags.copy(), 5.)
+        for x, y, z in zip(first, saved, second):
+            self.assertFalse(np.may_share_memory(x, z))
+            np.testing.assert_array_equal(x, y)
+
+class TestBaselineRows(unittest.TestCase):
+
+    def test_same_sigma_batched_after_smaller_group(self):
+        # baseline 0-1 has 2 rows, baselines 0-2, 0-3 and 1-2 have 3 rows, all with the same sigma
+        a_ant1 = np.array([0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 1])
+        a_ant2 = np.array([1, 2, 3, 2, 1, 2, 3, 2, 2, 3, 2])
+        bl_stddev = dict( (bl, 2.) for bl in [(0, 1), (0, 2), (0, 3), (1, 2)] )
+        bl_rows = BLsmooth.get_baseline_rows(a_ant1, a_ant2, bl_stddev, 4)
+        self.assertEqual([ idx.shape for idx, stddev in bl_rows ], [(1, 2), (3, 3)])
+        np.testing.assert_array_equal(bl_rows[0][0], [[0, 4]])
+        np.testing.assert_array_equal(bl_rows[1][0], [[1, 5, 8], [2, 6, 9], [3, 7, 10]])
+
+    def test_maxbatch(self):
+        a_ant1 = np.array([0, 0, 0, 1] * 2)
+        a_ant2 = np.array([1, 2, 3, 2] * 2)
+        bl_stddev = dict( (bl, 2.) for bl in [(0, 1), (0, 2), (0, 3), (1, 2)] )
+        bl_rows = BLsmooth.get_baseline_rows(a_ant1, a_ant2, bl_stddev, 4, maxbatch=3)
+        self.assertEqual([ idx.shape for idx, stddev in bl_rows ], [(3, 2), (1, 2)])
+
+if __name__ == '__main__':
+    unittest.main()